@@ -0,0 +1,614 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Camera backends.
+
+    "picamera" drives the camera module of the RPi. "simulated" replays recorded
+    motion vectors and JPEG/H.264 payloads at a configurable frame rate, so every
+    modus can run and be profiled on a normal Linux machine.
+
+    A recording directory for the simulated backend may contain:
+        motion.npy  : Array (frames, rows, cols) of motion.MOTION_DTYPE
+        motion.mvec : Motion vectors recorded with mtnVectorDir (motionlog.py)
+        video.h264  : Raw H.264 stream, replayed frame by frame
+        *.jpg       : Still images, returned in turn by capture()
+    Missing parts are generated.
+
+    picamera and numpy are imported when they are first needed, so importing
+    this module is cheap and does not touch the camera.
+"""
+import collections
+import glob
+import io
+import logging
+import os
+import threading
+import time
+
+PICAMERA = "picamera"
+SIMULATED = "simulated"
+
+logger = logging.getLogger(__name__)
+
+# --------------------------------------------------------------------------------
+# Clock. The simulated backend can run faster than real time, all waiting in
+# camera.py goes through sleep() and monotonic() to follow it.
+# --------------------------------------------------------------------------------
+speed = 1
+
+
+def monotonic():
+    return time.monotonic() * speed
+
+
+def sleep(seconds):
+    time.sleep(seconds / speed)
+
+
+def wait(event, timeout):
+    """ Waits for a threading.Event, returns True when it is set """
+    return event.wait(timeout / speed)
+
+
+# --------------------------------------------------------------------------------
+# Frame types, equal to picamera.PiVideoFrameType
+# --------------------------------------------------------------------------------
+FRAME, KEY_FRAME, SPS_HEADER, MOTION_DATA = range(4)
+
+# SPS and PPS of a 1920x1080 high profile stream, used in generated video
+HEADER = bytes.fromhex(
+    "0000000167640028acb200f0044fcb08000003000800000301e078c192400000000168ebc3cb22c0"
+)
+
+
+# --------------------------------------------------------------------------------
+def recording(camera, splitter_port=1):
+    """ Returns True when the camera records on the splitter port. The
+    recording property of PiCamera is True for any port.
+    """
+    if isinstance(camera, SimulatedCamera):
+        return splitter_port in camera._recordings
+    # PiCamera keeps an encoder per recording splitter port
+    return splitter_port in camera._encoders
+
+
+# --------------------------------------------------------------------------------
+def _picamera():
+    """ Imports picamera on first use """
+    try:
+        import picamera
+    except ImportError:
+        raise RuntimeError("picamera is not installed")
+    return picamera
+
+
+# --------------------------------------------------------------------------------
+def open_camera(name=PICAMERA, **kwargs):
+    """ Returns a new camera of the requested backend
+
+    Args:
+        name    : PICAMERA or SIMULATED
+        kwargs  : Passed to SimulatedCamera
+    """
+    global speed
+
+    logger.info("open_camera {}".format(name))
+    if name == PICAMERA:
+        picamera = _picamera()
+        speed = 1
+        return picamera.PiCamera()
+    if name == SIMULATED:
+        camera = SimulatedCamera(**kwargs)
+        speed = camera.speed
+        return camera
+    raise ValueError("Invalid backend: {}".format(name))
+
+
+# --------------------------------------------------------------------------------
+def circular_io(camera, seconds, bitrate=17000000):
+    """ Returns a ring buffer for H.264 recording which holds at least the last
+    seconds of video, like picamera.PiCameraCircularIO.
+
+    Args:
+        camera  : Camera which records to the buffer
+        seconds : Seconds of video to keep
+        bitrate : Bitrate of the recording, used to size the buffer
+    """
+    if isinstance(camera, SimulatedCamera):
+        return SimulatedCircularIO(camera, seconds, bitrate)
+    return _picamera().PiCameraCircularIO(camera, seconds=seconds, bitrate=bitrate)
+
+
+# ********************************************************************************
+
+
+class MotionAnalysis(io.IOBase):
+    """ Same as picamera.array.PiMotionAnalysis, for both backends, without
+    importing numpy before the first frame. Every write() is one frame of
+    motion vectors.
+    """
+
+    def __init__(self, camera, size=None):
+        super().__init__()
+        self.camera = camera
+        self.size = size
+        self.cols = None
+        self.rows = None
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        import numpy as np
+        import motion
+
+        if self.cols is None:
+            width, height = self.size or self.camera.resolution
+            self.rows, self.cols = motion.motion_grid(width, height)
+        self.analyse(
+            np.frombuffer(b, dtype=motion.MOTION_DTYPE).reshape((self.rows, self.cols))
+        )
+        return len(b)
+
+    def analyse(self, array):
+        pass
+
+
+# ********************************************************************************
+
+
+class SimulatedFrame:
+    """ Mirrors the attributes of picamera.PiVideoFrame """
+
+    __slots__ = (
+        "index",
+        "frame_type",
+        "frame_size",
+        "video_size",
+        "split_size",
+        "timestamp",
+        "complete",
+        "position",
+    )
+
+    def __init__(
+        self, index, frame_type, frame_size, video_size, split_size, timestamp
+    ):
+        self.index = index
+        self.frame_type = frame_type
+        self.frame_size = frame_size
+        self.video_size = video_size
+        self.split_size = split_size
+        self.timestamp = timestamp
+        self.complete = True
+        self.position = split_size - frame_size
+
+
+# ********************************************************************************
+
+
+class SimulatedSource:
+    """ The recorded (or generated) payloads replayed by SimulatedCamera
+
+    Args:
+        path        : Recording directory. Default = None (generate everything)
+        resolution  : (width, height) used to generate motion vectors
+        framerate   : Frame rate used to generate motion vectors
+    """
+
+    def __init__(self, path=None, resolution=(1920, 1080), framerate=30):
+        import numpy as np
+        import motion
+
+        self.path = path
+        self.motion = None
+        self.video = None
+        self.stills = []
+        if path:
+            fmotion = os.path.join(path, "motion.npy")
+            fvectors = os.path.join(path, "motion.mvec")
+            if os.path.isfile(fmotion):
+                self.motion = np.load(fmotion, mmap_mode="r")
+            elif os.path.isfile(fvectors):
+                import motionlog
+
+                self.motion = motionlog.VectorReader(fvectors).vectors
+            fvideo = os.path.join(path, "video.h264")
+            if os.path.isfile(fvideo):
+                with io.open(fvideo, "rb") as f:
+                    self.video = split_h264(f.read())
+            for fstill in sorted(glob.glob(os.path.join(path, "*.jpg"))):
+                with io.open(fstill, "rb") as f:
+                    self.stills.append(f.read())
+        if self.motion is None:
+            self.motion = generate_motion(
+                motion.motion_grid(*resolution), 30 * framerate, framerate
+            )
+        if not self.video:
+            self.video = [
+                (SPS_HEADER, HEADER),
+                (KEY_FRAME, b"\x00\x00\x00\x01\x65\x88" + b"\x5a" * 256),
+            ] + [(FRAME, b"\x00\x00\x00\x01\x41\x9a" + b"\x5a" * 64)] * 98
+        # Inserted when a recording is split, like the encoder does
+        self.header = next(
+            (data for frame_type, data in self.video if frame_type == SPS_HEADER),
+            HEADER,
+        )
+        if not self.stills:
+            self.stills = [b"\xff\xd8" + bytes(1024) + b"\xff\xd9"]
+        self._raw = {}
+        logger.debug(
+            "Source {}: {} motion frames, {} video frames, {} stills".format(
+                path, len(self.motion), len(self.video), len(self.stills)
+            )
+        )
+
+    def raw(self, index, resolution):
+        """ Returns a raw YUV420 frame in the padded layout of the camera. The
+        luma shows the motion vectors of the frame, scaled to the resolution, on
+        a gray background.
+        """
+        import numpy as np
+        import stream
+
+        buffers = self._raw.get(resolution)
+        if buffers is None:
+            width, height = resolution
+            fwidth, fheight = stream.padded(width, height)
+            rows, cols = self.motion.shape[1:]
+            data = np.full(fwidth * fheight * 3 // 2, 128, dtype=np.uint8)
+            y = data[: fwidth * fheight].reshape((fheight, fwidth))[:height, :width]
+            # The macroblock of every pixel, without the extra column
+            r = (np.arange(height) * rows // height)[:, None]
+            c = (np.arange(width) * (cols - 1) // width)[None, :]
+            buffers = self._raw[resolution] = (data, y, r, c)
+        data, y, r, c = buffers
+        a = self.motion[index % len(self.motion)]
+        luma = np.abs(a["x"].astype(np.int16)) + np.abs(a["y"].astype(np.int16))
+        luma = np.clip(64 + 2 * luma, 0, 235).astype(np.uint8)
+        y[:] = luma[r, c]
+        return data.data
+
+
+# --------------------------------------------------------------------------------
+def generate_motion(shape, frames=300, framerate=10):
+    """ Returns noise with a moving object for 2 out of every 10 seconds """
+    import numpy as np
+    import motion
+
+    rng = np.random.default_rng(0)
+    a = np.zeros((frames,) + shape, dtype=motion.MOTION_DTYPE)
+    a["x"] = rng.integers(-6, 7, size=a.shape)
+    a["y"] = rng.integers(-6, 7, size=a.shape)
+    a["sad"] = rng.integers(0, 500, size=a.shape)
+    rows, cols = shape
+    for i in range(frames):
+        t = i % (10 * framerate)
+        if t < 2 * framerate:
+            col = t * (cols - 8) // (2 * framerate)
+            a["x"][i, rows // 2 : rows // 2 + 6, col : col + 8] = 100
+    return a
+
+
+# --------------------------------------------------------------------------------
+def split_h264(data):
+    """ Splits a raw H.264 stream in a list of (frame_type, bytes) per frame.
+    SPS/PPS headers are returned as separate frames, like picamera does.
+    """
+    frames = []
+    header = b""
+    starts = []
+    i = data.find(b"\x00\x00\x01")
+    while i >= 0:
+        starts.append(i - 1 if i > 0 and data[i - 1] == 0 else i)
+        i = data.find(b"\x00\x00\x01", i + 3)
+    starts.append(len(data))
+    for begin, end in zip(starts, starts[1:]):
+        nal = data[begin:end]
+        nal_type = nal[nal.index(b"\x01") + 1] & 0x1F if b"\x01" in nal else 0
+        if nal_type in (7, 8):
+            header += nal
+            continue
+        if header:
+            frames.append((SPS_HEADER, header))
+            header = b""
+        frames.append((KEY_FRAME if nal_type == 5 else FRAME, nal))
+    return frames
+
+
+# ********************************************************************************
+
+
+class SimulatedCamera:
+    """ Software camera with the parts of the picamera.PiCamera interface used by
+    camera.py. Recording runs in a thread per splitter port and delivers frames
+    at framerate * speed.
+
+    Args:
+        source  : Recording directory. Default = None (generate payloads)
+        speed   : Replay speed, 1 = real time
+    """
+
+    revision = "simulated"
+
+    def __init__(self, source=None, speed=1):
+        self.speed = speed
+        self.resolution = (1920, 1080)
+        self.rotation = 0
+        self.vflip = False
+        self.hflip = False
+        self.annotate_text_size = 32
+        self.annotate_text = ""
+        self.framerate = 30
+        self.led = False
+        self.awb_mode = "auto"
+        self.exposure_mode = "auto"
+        self.shutter_speed = 0
+        self.iso = 0
+        self.frame = None
+        self.closed = False
+        self._source_path = source
+        self._source = None
+        self._still = 0
+        self._index = 0
+        self._recordings = {}
+        # Statistics
+        self.captures = 0
+        self.capture_time = 0.0
+        self.frames = 0
+        self.dropped = 0
+        self.analyse_count = 0
+        self.analyse_time = 0.0
+        self.analyse_max = 0.0
+
+    @property
+    def recording(self):
+        return bool(self._recordings)
+
+    @property
+    def source(self):
+        if self._source is None:
+            self._source = SimulatedSource(
+                self._source_path, self.resolution, int(self.framerate)
+            )
+        return self._source
+
+    def close(self):
+        for port in list(self._recordings):
+            self.stop_recording(splitter_port=port)
+        self.closed = True
+
+    def capture(self, output, format=None, use_video_port=False, **options):
+        start = time.perf_counter()
+        if format == "yuv":
+            # The scene at this moment, as the analysis stream shows it
+            size = tuple(options.get("resize") or self.resolution)
+            data = self.source.raw(int(monotonic() * float(self.framerate)), size)
+        else:
+            stills = self.source.stills
+            data = stills[self._still % len(stills)]
+            self._still += 1
+        if isinstance(output, str):
+            with io.open(output, "wb") as f:
+                f.write(data)
+        elif output is not None:
+            output.write(data)
+        self.captures += 1
+        self.capture_time += time.perf_counter() - start
+
+    def capture_sequence(self, outputs, format=None, use_video_port=False, **options):
+        for output in outputs:
+            self.capture(output, format, use_video_port, **options)
+
+    def capture_continuous(self, output, format=None, use_video_port=False, **options):
+        while True:
+            self.capture(output, format, use_video_port, **options)
+            yield output
+
+    def start_recording(
+        self, output, format=None, splitter_port=1, motion_output=None, **options
+    ):
+        if splitter_port in self._recordings:
+            raise RuntimeError("Port {} is already recording".format(splitter_port))
+        frames = None
+        if format == "yuv":
+            size = tuple(options.get("resize") or self.resolution)
+            frames = lambda index: self.source.raw(index, size)
+        elif format == "mjpeg":
+            frames = lambda index: self.source.stills[index % len(self.source.stills)]
+        recording = _SimulatedRecording(
+            self, output, motion_output, options.get("intra_period"), frames
+        )
+        self._recordings[splitter_port] = recording
+        recording.start()
+
+    def split_recording(self, output, splitter_port=1, **options):
+        self._recordings[splitter_port].split(output)
+
+    def wait_recording(self, timeout=0, splitter_port=1):
+        recording = self._recordings[splitter_port]
+        recording.check()
+        if timeout:
+            recording.stopped.wait(timeout / self.speed)
+            recording.check()
+
+    def stop_recording(self, splitter_port=1):
+        recording = self._recordings.pop(splitter_port)
+        recording.stop()
+        recording.check()
+
+
+# ********************************************************************************
+
+
+class _SimulatedRecording(threading.Thread):
+    def __init__(self, camera, output, motion_output, intra_period=None, frames=None):
+        super().__init__(daemon=True)
+        self.camera = camera
+        self.motion_output = motion_output
+        self.intra_period = intra_period
+        # Function(index) returning the YUV or MJPEG frames, None for H.264
+        self.frames = frames
+        self.stopped = threading.Event()
+        self.error = None
+        self.lock = threading.Lock()
+        self.output = None
+        self.opened = False
+        self.split(output)
+
+    def split(self, output):
+        with self.lock:
+            self._close_output()
+            if isinstance(output, str):
+                self.output = io.open(output, "wb")
+                self.opened = True
+            else:
+                self.output = output
+                self.opened = False
+            self.split_size = 0
+            self.split_pending = True
+
+    def _close_output(self):
+        if self.opened:
+            self.output.close()
+        self.output = None
+
+    def check(self):
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        with self.lock:
+            self._close_output()
+
+    def run(self):
+        camera = self.camera
+        source = camera.source
+        interval = 1.0 / (float(camera.framerate) * camera.speed)
+        video_size = 0
+        index = camera._index
+        since_header = 0
+        deadline = time.monotonic()
+        try:
+            while not self.stopped.is_set():
+                deadline += interval
+                if self.frames is not None:
+                    with self.lock:
+                        if self.output is not None:
+                            self.output.write(self.frames(index))
+                    index += 1
+                    delay = deadline - time.monotonic()
+                    if delay > 0:
+                        self.stopped.wait(delay)
+                    else:
+                        deadline = time.monotonic()
+                    continue
+                frame_type, data = source.video[index % len(source.video)]
+                with self.lock:
+                    if self.split_pending or (
+                        self.intra_period and since_header >= self.intra_period
+                    ):
+                        # Like the encoder, a split starts at the next header
+                        if frame_type != SPS_HEADER:
+                            frame_type, data = SPS_HEADER, source.header
+                            index -= 1
+                        self.split_pending = False
+                    if frame_type == SPS_HEADER:
+                        since_header = 0
+                    else:
+                        since_header += 1
+                    video_size += len(data)
+                    self.split_size += len(data)
+                    camera.frame = SimulatedFrame(
+                        index,
+                        frame_type,
+                        len(data),
+                        video_size,
+                        self.split_size,
+                        int(index * 1000000 / camera.framerate),
+                    )
+                    if self.output is not None:
+                        self.output.write(data)
+                if self.motion_output is not None and frame_type != SPS_HEADER:
+                    vectors = source.motion[index % len(source.motion)]
+                    start = time.perf_counter()
+                    self.motion_output.write(vectors.tobytes())
+                    elapsed = time.perf_counter() - start
+                    camera.analyse_count += 1
+                    camera.analyse_time += elapsed
+                    camera.analyse_max = max(camera.analyse_max, elapsed)
+                camera.frames += 1
+                index += 1
+                # The replay continues where the previous recording stopped
+                camera._index = index
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self.stopped.wait(delay)
+                else:
+                    # Behind schedule: drop frames like the encoder would
+                    skipped = int(-delay / interval)
+                    camera.dropped += skipped
+                    deadline += skipped * interval
+        except Exception as e:
+            logger.exception("Simulated recording failed")
+            self.error = e
+
+
+# ********************************************************************************
+
+
+class SimulatedCircularIO:
+    """ The parts of picamera.PiCameraCircularIO used with a SimulatedCamera.
+    Keeps whole frames, bounded by bytes (seconds * bitrate) and by seconds.
+    """
+
+    def __init__(self, camera, seconds, bitrate=17000000):
+        self.camera = camera
+        self.seconds = seconds
+        self.size = seconds * bitrate // 8
+        self.lock = threading.Lock()
+        self._frames = collections.deque()
+        self._bytes = 0
+
+    @property
+    def frames(self):
+        with self.lock:
+            return [frame for frame, data in self._frames]
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        frame = self.camera.frame
+        with self.lock:
+            self._frames.append((frame, bytes(b)))
+            self._bytes += len(b)
+            oldest = frame.timestamp - self.seconds * 1000000
+            while len(self._frames) > 1 and (
+                self._bytes > self.size or self._frames[0][0].timestamp < oldest
+            ):
+                self._bytes -= len(self._frames.popleft()[1])
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def clear(self):
+        with self.lock:
+            self._frames.clear()
+            self._bytes = 0
+
+    def copy_to(self, output, size=None, seconds=None, first_frame=SPS_HEADER):
+        with self.lock:
+            frames = list(self._frames)
+        if seconds is not None and frames:
+            oldest = frames[-1][0].timestamp - seconds * 1000000
+            frames = [f for f in frames if f[0].timestamp >= oldest]
+        if first_frame is not None:
+            while frames and frames[0][0].frame_type != first_frame:
+                frames.pop(0)
+        for frame, data in frames:
+            output.write(data)
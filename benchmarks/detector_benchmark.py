@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Compares the motion vector detector of detect_motion (motion.MotionScorer on
+    the 1920x1080 grid) with the frame difference detector of detect_pixels
+    (motion.FrameDifference on the 320x240 analysis stream).
+
+    Both get a generated scene with noise and an object which passes for 2 sec.
+    every 10 sec. Reported are the frames per second of one core, the CPU load
+    at the camera frame rate and the number of triggers.
+
+    Usage: python3 benchmarks/detector_benchmark.py [seconds] [framerate]
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import motion
+
+RESOLUTION = (1920, 1080)
+STREAM = (320, 240)
+STILL_SEC = 1
+
+
+# --------------------------------------------------------------------------------
+def scene(frames, framerate):
+    """ Returns (vectors, luma) of the same scene: noise, and an object of
+    1/8 of the image which passes for 2 sec. every 10 sec.
+    """
+    rng = np.random.default_rng(3)
+    shape = motion.motion_grid(*RESOLUTION)
+    rows, cols = shape
+    width, height = STREAM
+    vectors = np.zeros((frames,) + shape, dtype=motion.MOTION_DTYPE)
+    vectors["x"] = rng.integers(-6, 7, size=vectors.shape)
+    vectors["y"] = rng.integers(-6, 7, size=vectors.shape)
+    base = np.linspace(40, 200, width, dtype=np.float32)[None, :].repeat(height, 0)
+    luma = np.empty((frames, height, width), dtype=np.uint8)
+    for i in range(frames):
+        luma[i] = np.clip(base + rng.normal(0, 4, (height, width)), 0, 255)
+        t = i % (10 * framerate)
+        if t < 2 * framerate:
+            col = t * (cols - 10) // (2 * framerate)
+            vectors["x"][i, 20:30, col : col + 10] = 90
+            x = col * width // cols
+            luma[i, 60:120, x : x + width // 8] = 20
+    return vectors, luma
+
+
+# --------------------------------------------------------------------------------
+def run(detector, frames, framerate):
+    """ Returns (triggers, false triggers, wall, cpu) per frame """
+    triggers = []
+    cpu = time.process_time()
+    start = time.perf_counter()
+    for i in range(len(frames)):
+        if detector.detect(frames[i], now=i / framerate):
+            triggers.append(i)
+    wall = (time.perf_counter() - start) / len(frames)
+    cpu = (time.process_time() - cpu) / len(frames)
+    false = sum(1 for i in triggers if i % (10 * framerate) >= 2 * framerate)
+    return len(triggers), false, wall, cpu
+
+
+# --------------------------------------------------------------------------------
+def main():
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    framerate = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    vectors, luma = scene(seconds * framerate, framerate)
+    print(
+        "{} frames, {} events, at {} fps".format(
+            len(vectors), (seconds + 9) // 10, framerate
+        )
+    )
+    detectors = (
+        ("vectors", motion.MotionScorer(80, 10, STILL_SEC), vectors),
+        ("pixels", motion.FrameDifference(25, 100, 0.05, STILL_SEC), luma),
+        ("pixels/2", motion.FrameDifference(25, 25, 0.05, STILL_SEC, step=2), luma),
+    )
+    for name, detector, frames in detectors:
+        triggers, false, wall, cpu = run(detector, frames, framerate)
+        print(
+            "{:<9} {:8.1f} us/frame {:8.0f} frames/s {:6.2f}% CPU {:4d} triggers, {} false".format(
+                name, wall * 1e6, 1 / wall, 100 * cpu * framerate, triggers, false
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
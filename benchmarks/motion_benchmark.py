@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Micro benchmark of the motion scoring per frame.
+
+    Compares the original float based scoring of detect_motion.analyse with
+    motion.MotionScorer on the motion vector grid of a 1920x1080 recording, and
+    measures motion.BlobFinder on the result.
+
+    Usage: python3 benchmarks/motion_benchmark.py [frames]
+"""
+import os
+import sys
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import motion
+
+WIDTH = 1920
+HEIGHT = 1080
+MAGNITUDE = 80
+
+
+# --------------------------------------------------------------------------------
+def make_frames(count, shape):
+    """ Random noise with a moving block of large vectors, and vectors around
+    the magnitude, where the truncation of the legacy scoring decides
+    """
+    rng = np.random.default_rng(1)
+    frames = np.zeros((count,) + shape, dtype=motion.MOTION_DTYPE)
+    frames["x"] = rng.integers(-8, 9, size=frames.shape)
+    frames["y"] = rng.integers(-8, 9, size=frames.shape)
+    for i in range(count):
+        col = i % (shape[1] - 10)
+        frames["x"][i, 20:30, col : col + 10] = 90
+        # Magnitudes from MAGNITUDE - 1 to MAGNITUDE + 2, eg. (80, 10) = 80.6
+        frames["x"][i, 40:44, :] = rng.integers(
+            MAGNITUDE - 2, MAGNITUDE + 2, size=(4, shape[1])
+        )
+        frames["y"][i, 40:44, :] = rng.integers(-14, 15, size=(4, shape[1]))
+    return frames
+
+
+# --------------------------------------------------------------------------------
+def legacy(a):
+    a = (
+        np.sqrt(
+            np.square(a["x"].astype(np.float64)) + np.square(a["y"].astype(np.float64))
+        )
+        .clip(0, 255)
+        .astype(np.uint8)
+    )
+    return (a > MAGNITUDE).sum()
+
+
+# --------------------------------------------------------------------------------
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    shape = motion.motion_grid(WIDTH, HEIGHT)
+    frames = make_frames(count, shape)
+    scorer = motion.MotionScorer(MAGNITUDE)
+
+    for i in range(count):
+        assert legacy(frames[i]) == scorer.score(frames[i])
+
+    print("Grid {}x{} -> {} motion vectors".format(WIDTH, HEIGHT, shape))
+    for name, func in (("legacy", legacy), ("MotionScorer", scorer.score)):
+        elapsed = min(
+            timeit.repeat(
+                lambda: [func(frames[i]) for i in range(count)], number=1, repeat=5
+            )
+        )
+        print("{:<14} {:8.1f} us/frame".format(name, elapsed / count * 1e6))
+
+    blobs = motion.BlobFinder(8)
+    for i in range(count):
+        scorer.score(frames[i])
+        blobs.find(scorer._moving)
+    print(
+        "{:<14} {:8.1f} us/frame, max. {:.1f} us".format(
+            "BlobFinder", blobs.total_time / count * 1e6, blobs.max_time * 1e6
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Checks the MP4 files of mp4.Mp4Writer with an external decoder (PyAV).
+
+    A generated scene is encoded to raw H.264 with libx264, remuxed with
+    Mp4Writer and decoded again. Checked are the size of the tkhd box, the
+    display matrix, the resolution, the rotation, the number of frames and
+    keyframes, the duration and seeking. With file arguments only those files
+    are checked, against the resolution in their SPS.
+
+    Usage: python3 benchmarks/mp4_check.py [FILE.mp4 ...]
+
+    Needs PyAV (pip3 install av) and numpy.
+"""
+import io
+import os
+import struct
+import sys
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import mp4
+
+WIDTH = 640
+HEIGHT = 480
+FRAMERATE = 30
+FRAMES = 90
+KEYFRAMES = 15
+
+
+# --------------------------------------------------------------------------------
+def encode(av):
+    """ Returns a raw H.264 (Annex B) stream of a generated scene """
+    raw = io.BytesIO()
+    codec = av.CodecContext.create("libx264", "w")
+    codec.width = WIDTH
+    codec.height = HEIGHT
+    codec.pix_fmt = "yuv420p"
+    codec.framerate = FRAMERATE
+    codec.options = {"x264-params": "annexb=1:scenecut=0:keyint={}".format(KEYFRAMES)}
+    for i in range(FRAMES):
+        image = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+        image[:, : (i * 7) % WIDTH] = 200
+        frame = av.VideoFrame.from_ndarray(image, format="rgb24")
+        for packet in codec.encode(frame.reformat(format="yuv420p")):
+            raw.write(bytes(packet))
+    for packet in codec.encode(None):
+        raw.write(bytes(packet))
+    return raw.getvalue()
+
+
+# --------------------------------------------------------------------------------
+def find_box(data, kind):
+    """ Returns (offset, size) of the first box kind, walking the box tree """
+    containers = (b"moov", b"trak", b"mdia", b"minf", b"stbl")
+    offset = 0
+    end = len(data)
+    while offset < end:
+        size, name = struct.unpack(">I4s", data[offset : offset + 8])
+        if size == 1:
+            # 64 bit size, eg. of mdat
+            size = struct.unpack(">Q", data[offset + 8 : offset + 16])[0]
+        elif size == 0:
+            # Up to the end of the file
+            size = end - offset
+        if name == kind:
+            return offset, size
+        if name in containers:
+            end = offset + size
+            offset += 8
+        else:
+            offset += size
+    raise ValueError("No {} box".format(kind.decode()))
+
+
+# --------------------------------------------------------------------------------
+def check(av, path, frames=None, keyframes=None):
+    """ Returns a list of errors of an MP4 file """
+    errors = []
+    data = open(path, "rb").read()
+    offset, size = find_box(data, b"tkhd")
+    if size != 92:
+        errors.append("tkhd is {} bytes, not 92".format(size))
+    matrix = struct.unpack(">9I", data[offset + 48 : offset + 84])
+    if matrix != struct.unpack(">9I", mp4.MATRIX):
+        errors.append("tkhd matrix is not identity: {}".format(matrix))
+    width, height = struct.unpack(">II", data[offset + 84 : offset + 92])
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        if (width >> 16, height >> 16) != (stream.width, stream.height):
+            errors.append(
+                "tkhd size {}x{}, stream {}x{}".format(
+                    width >> 16, height >> 16, stream.width, stream.height
+                )
+            )
+        count = 0
+        keys = 0
+        for packet in container.demux(stream):
+            if packet.size:
+                keys += packet.is_keyframe
+        container.seek(0)
+        for frame in container.decode(stream):
+            count += 1
+            if frame.rotation:
+                errors.append("frame {} rotated {}".format(count, frame.rotation))
+                break
+        duration = float(stream.duration * stream.time_base)
+        if frames is not None:
+            if count != frames:
+                errors.append("{} frames decoded, not {}".format(count, frames))
+            if abs(duration - frames / FRAMERATE) > 1.0 / FRAMERATE:
+                errors.append("duration {:.3f} sec.".format(duration))
+        if keyframes is not None and keys != keyframes:
+            errors.append("{} keyframes, not {}".format(keys, keyframes))
+        # Seek to the middle, it must land on a keyframe
+        container.seek(int(duration / 2 / stream.time_base), stream=stream)
+        frame = next(container.decode(stream), None)
+        if frame is None:
+            errors.append("seeking to {:.1f} sec. failed".format(duration / 2))
+    print(
+        "{}: {} frames, {} keyframes, {:.2f} sec., {}x{}".format(
+            path, count, keys, duration, width >> 16, height >> 16
+        )
+    )
+    return errors
+
+
+# --------------------------------------------------------------------------------
+def main():
+    try:
+        import av
+    except ImportError:
+        sys.exit("PyAV is not installed: pip3 install av")
+    errors = []
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            errors += check(av, path)
+    else:
+        fd, path = tempfile.mkstemp(suffix=".mp4")
+        with os.fdopen(fd, "wb") as output:
+            writer = mp4.Mp4Writer(output, FRAMERATE, (WIDTH, HEIGHT))
+            writer.write(encode(av))
+            writer.close()
+        errors += check(av, path, FRAMES, -(-FRAMES // KEYFRAMES))
+        os.remove(path)
+    for error in errors:
+        print("ERROR: {}".format(error))
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
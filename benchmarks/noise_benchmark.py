@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Compares the fixed motion rule with the adaptive noise model (NoiseModel).
+
+    Without a recording, a noisy night scene with rain is generated in which an
+    object passes every 20 seconds, so false and missed triggers can be counted.
+    With a recording (motion.npy, see backend.py) only the triggers are counted.
+
+    Usage: python3 benchmarks/noise_benchmark.py [motion.npy] [framerate]
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import motion
+
+MAGNITUDE = 20
+OBJECT = 80
+VECTORS = 10
+STILL_SEC = 1
+
+
+# --------------------------------------------------------------------------------
+def night_scene(frames, framerate, shape=motion.motion_grid(1920, 1080)):
+    """ Returns (vectors, truth): sensor noise which is stronger in the lower
+    half, rain every other 30 sec., and an object passing for 2 sec. every 20 sec.
+    """
+    rng = np.random.default_rng(2)
+    a = np.zeros((frames,) + shape, dtype=motion.MOTION_DTYPE)
+    rows, cols = shape
+    noise = np.ones(shape)
+    noise[rows // 2 :] = 2
+    truth = np.zeros(frames, dtype=np.bool_)
+    for i in range(frames):
+        scale = noise * (2 if (i // (30 * framerate)) % 2 else 1)
+        a["x"][i] = np.clip(rng.normal(0, 4 * scale), -128, 127)
+        a["y"][i] = np.clip(rng.normal(0, 4 * scale), -128, 127)
+        t = i % (20 * framerate)
+        if t < 2 * framerate:
+            col = t * (cols - 10) // (2 * framerate)
+            a["x"][i, 10:20, col : col + 10] = OBJECT
+            truth[i] = True
+    return a, truth
+
+
+# --------------------------------------------------------------------------------
+def run(vectors, framerate, noise):
+    scorer = motion.MotionScorer(MAGNITUDE, VECTORS, STILL_SEC, noise=noise)
+    triggers = []
+    cpu = time.process_time()
+    start = time.perf_counter()
+    for i in range(len(vectors)):
+        if scorer.detect(vectors[i], now=i / framerate):
+            triggers.append(i)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    return triggers, elapsed / len(vectors), cpu / len(vectors)
+
+
+# --------------------------------------------------------------------------------
+def main():
+    framerate = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    if len(sys.argv) > 1:
+        vectors = np.load(sys.argv[1], mmap_mode="r")
+        truth = None
+    else:
+        vectors, truth = night_scene(120 * framerate, framerate)
+    print("{} frames of {} motion vectors".format(len(vectors), vectors.shape[1:]))
+    for name, noise in (("fixed", None), ("noise model", motion.NoiseModel())):
+        triggers, wall, cpu = run(vectors, framerate, noise)
+        line = "{:<12} {:5d} triggers {:8.1f} us/frame {:8.1f} us CPU/frame".format(
+            name, len(triggers), wall * 1e6, cpu * 1e6
+        )
+        if truth is not None:
+            false = sum(1 for i in triggers if not truth[i])
+            events = np.flatnonzero(np.diff(truth.astype(np.int8)) == 1) + 1
+            events = np.append(np.flatnonzero(truth[:1]), events)
+            missed = sum(
+                1
+                for e in events
+                if not any(e <= i < e + 2 * framerate for i in triggers)
+            )
+            line += " {:5d} false {:3d}/{} missed".format(false, missed, len(events))
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
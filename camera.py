@@ -4,18 +4,29 @@
 # Based on:
 #   //github.com/pageauc/pi-timolo
 # ================================================================================
-# import RPi.GPIO as GPIO
 import os
 import datetime
 import sys
 import time
-import picamera
-import picamera.array
 import logging
+import backend
+import catalogue
+import contextvars
+import fingerprint
+import functools
+import metrics
 import modus
+import pir
+import profiler
+import recorder
+import runloop
+import scheduler
 import signal
+import storage
+import stream
+import threading
 import io
-import numpy as np
+import writer
 from fractions import Fraction
 from config import *
 
@@ -33,17 +44,88 @@ camNightShutSpeed = 6 * SECONDS2MICRO
 # ================================================================================
 appName = "Camera"
 appVersion = "0.2"
-camera = picamera.PiCamera()
-procesTime = 1
+# Motion detectors, see mtnDetector
+VECTORS = "vectors"
+PIXELS = "pixels"
+# Manifest of the skipped timelapse images in gbImageDir, see tlSkipDuplicates.
+# Hidden, like .sequence, so the quota manager leaves it alone
+SKIPPED_MANIFEST = ".skipped.csv"
+# Size of the frame for the fingerprint, without the analysis stream
+FINGERPRINT_SIZE = (64, 48)
+# Modi which record on the video port
+RECORDING_MODI = (modus.MOTIONIMAGE, modus.MOTIONVIDEO, modus.PIRVIDEO)
+# The camera is opened by the modus, see open_camera()
+camera = None
+# Start of the process and seconds until the camera was ready, see log_startup()
+startTime = time.monotonic()
+startupTime = None
 
 # --------------------------------------------------------------------------------
 # Globals
 # --------------------------------------------------------------------------------
 actionCount = 0
 imageCount = 1
-motion_detected = False
-last_still_capture_time = datetime.datetime.now()
+motion_event = runloop.Trigger()
+# The modi of appModus, which run as tasks of runLoop, see main()
+appModi = []
+runLoop = None
+# The modus of the running task
+taskModus = contextvars.ContextVar("taskModus", default=None)
+# One capture at a time, when several modi take images
+cameraLock = threading.Lock()
+# Moving vectors and motion.BlobStats of the last detected motion
+motionScore = 0
+motionBlobs = None
 imgExtension = "jpg"
+captureWriter = None
+pirSensor = None
+# Subdirectories and persistent sequence numbers, see storage.py
+imageDirs = None
+videoDirs = None
+imageSequence = None
+videoSequence = None
+# storage.QuotaManager, when gbQuotaBytes or gbMinFreeBytes is set
+quotaManager = None
+# catalogue.Catalogue, when gbCatalogue is set, and the time and motion of the
+# captures which are not on disk yet
+captureCatalogue = None
+captureInfo = {}
+# Time (time.monotonic()) of the trigger which has no file yet
+triggerTime = None
+metricsServer = None
+# stream.FrameStream for the analysis which needs pixels, when camStream is set
+analysisStream = None
+# liveview.LiveView, when appLiveViewPort is set
+liveView = None
+# Luma of the latest analysis stream frame, for the timelapse fingerprint
+streamLuma = None
+
+# --------------------------------------------------------------------------------
+# Metrics, see metrics.py
+# --------------------------------------------------------------------------------
+analyseSeconds = metrics.histogram(
+    "camera_analyse_seconds", "Time to analyse the motion vectors of a frame"
+)
+framesTotal = metrics.counter("camera_frames_total", "Frames analysed")
+framesDropped = metrics.counter(
+    "camera_frames_dropped_total", "Frames which did not arrive at analyse"
+)
+motionTotal = metrics.counter("camera_motion_total", "Frames with motion")
+captureSeconds = metrics.histogram(
+    "camera_capture_seconds", "Time capture_image waits for the camera"
+)
+triggerSeconds = metrics.histogram(
+    "camera_trigger_to_file_seconds",
+    "Time from motion or PIR trigger until the file is on disk (images) or open (videos)",
+)
+brightness = metrics.gauge(
+    "camera_brightness", "Mean luma (0..255) of the analysis stream"
+)
+eventSeconds = metrics.histogram(
+    "camera_event_seconds",
+    "Duration of the recorded events",
+    (1, 2, 5, 10, 20, 30, 60, 120, 300, 600),
+)
 
 # --------------------------------------------------------------------------------
 # Logging
@@ -66,13 +148,6 @@ __MODI = [
     modus.TIMELAPSE,
 ]
 
-# --------------------------------------------------------------------------------
-# Setup PIR
-# --------------------------------------------------------------------------------
-# Setting the GPIO (General Purpose Input Output) pins up so we can detect if they are HIGH or LOW (on or off)
-# GPIO.setmode(GPIO.BOARD)
-# GPIO.setup(pirSensorPin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-
 # --------------------------------------------------------------------------------
 # The 'analyse' method gets called on every frame processed while picamera
 # is recording h264 video.
@@ -87,17 +162,16 @@ def check_folders():
     logger.info("check_folders")
 
     # Checks for image folders and creates them if they do not already exist.
-    if (
-        appModus == modus.TESTIMAGE
-        or appModus == modus.MOTIONIMAGE
-        or appModus == modus.TIMELAPSE
+    if any(
+        m in appModi
+        for m in (modus.TESTIMAGE, modus.MOTIONIMAGE, modus.TIMELAPSE, modus.PIRIMAGE)
     ):
         if not os.path.isdir(gbImageDir):
             logger.debug("Creating image folder {}".format(gbImageDir))
             os.makedirs(gbImageDir)
         logger.debug("Folder {}".format(gbImageDir))
 
-    if appModus == modus.MOTIONVIDEO:
+    if modus.MOTIONVIDEO in appModi or modus.PIRVIDEO in appModi:
         if not os.path.isdir(gbVideoDir):
             logger.debug("Creating video folder {}".format(gbVideoDir))
             os.makedirs(gbVideoDir)
@@ -108,15 +182,12 @@ def check_folders():
 def signal_term_handler(signal, frame):
 
     logger.critical("signal_term_handler")
-    # this raises SystemExit(0) which fires all "try...finally" blocks:
+    # this raises SystemExit(0) which fires all "try...finally" blocks. The run
+    # loop cancels the modi and waits for the captures in flight, then main()
+    # closes the writer, which writes the captures which are still in memory:
     sys.exit(0)
 
 
-# this is useful when this program is started at boot via init.d
-# or an upstart script, so it can be killed: i.e. kill some_pid:
-signal.signal(signal.SIGTERM, signal_term_handler)
-
-
 # --------------------------------------------------------------------------------
 def show_time():
     return datetime.datetime.now().strftime(gbDateTimeFormat)
@@ -125,21 +196,46 @@ def show_time():
 # --------------------------------------------------------------------------------
 def ctrl_c():
     logger.critical("ctrl_c")
-    # GPIO.cleanup()
+
+
+# --------------------------------------------------------------------------------
+def open_camera():
+    """ Opens the camera, or reuses the camera which is still open from a
+    previous modus (warm restart).
+    """
+    global camera
+
+    if camera is not None and not camera.closed:
+        logger.info("open_camera: reusing the open camera")
+        return
+    start = time.monotonic()
+    camera = backend.open_camera(appBackend, source=simSource, speed=simSpeed)
+    logger.info("Camera opened in {:.3f} sec.".format(time.monotonic() - start))
 
 
 # --------------------------------------------------------------------------------
 def close_camera():
     logger.info("close_camera")
+    if camera is None:
+        return
     camera.close()
-    # GPIO.cleanup()
     logger.info("Actions: {}".format(actionCount))
     logger.debug("Camera turned off")
 
 
+# --------------------------------------------------------------------------------
+def close_writer():
+    global captureWriter
+
+    if captureWriter is not None:
+        captureWriter.close()
+        captureWriter = None
+
+
 # --------------------------------------------------------------------------------
 def init_camera():
     logger.info("init_camera")
+    open_camera()
     revision = camera.revision
     if revision == "ov5647":
         version = "V1.x"
@@ -149,7 +245,7 @@ def init_camera():
         version = "unknown"
     logger.info("camera version: {}".format(version))
     # Global settings
-    camera.resolution = (camHeight, camWidth)
+    camera.resolution = (camWidth, camHeight)
     camera.rotation = camRotation
     camera.vflip = camVFlip
     camera.hflip = camHFlip
@@ -160,7 +256,7 @@ def init_camera():
 
     # Specific settings
     # Video settings
-    if appModus == modus.MOTIONVIDEO:
+    if all(m in (modus.MOTIONVIDEO, modus.PIRVIDEO) for m in appModi):
         logger.debug("vidVideoTime = {}".format(vidVideoTime))
     # Image settings
     else:
@@ -190,55 +286,212 @@ def init_camera():
     logger.debug("camera.awb_mode = {}".format(camera.awb_mode))
     logger.debug("camera.shutter_speed = {}".format(camera.shutter_speed))
     logger.debug("camera.iso = {}".format(camera.iso))
+    if camStream or (
+        mtnDetector == PIXELS
+        and (modus.MOTIONIMAGE in appModi or modus.MOTIONVIDEO in appModi)
+    ):
+        open_stream()
+    if appLiveViewPort:
+        open_liveview()
     logger.info("Camera initialized")
 
 
 # --------------------------------------------------------------------------------
+def open_stream():
+    """ Starts the low resolution analysis stream on splitter port 2 """
+    global analysisStream
+
+    analysisStream = stream.FrameStream(camera, (camStreamWidth, camStreamHeight))
+    analysisStream.subscribe(measure_brightness)
+    if tlSkipDuplicates and modus.TIMELAPSE in appModi:
+        analysisStream.subscribe(keep_luma)
+    analysisStream.start()
+
+
+# --------------------------------------------------------------------------------
+def close_stream():
+    global analysisStream
+
+    global streamLuma
+
+    if analysisStream is not None:
+        analysisStream.stop()
+        analysisStream = None
+        streamLuma = None
+
+
+# --------------------------------------------------------------------------------
+def open_liveview():
+    """ Starts the MJPEG live view server, the camera records on splitter port 3
+    while a viewer is connected
+    """
+    global liveView
+
+    # asyncio is only imported with the live view
+    import liveview
 
+    liveView = liveview.LiveView(
+        camera, appLiveViewPort, resolution=(appLiveViewWidth, appLiveViewHeight)
+    )
+    liveView.start()
 
-def capture_image(fname):
+
+# --------------------------------------------------------------------------------
+def close_liveview():
+    global liveView
+
+    if liveView is not None:
+        liveView.stop()
+        liveView = None
+
+
+# --------------------------------------------------------------------------------
+def measure_brightness(frame):
+    """ Analysis stream subscriber: mean luma of every 8th pixel """
+    brightness.set(float(frame.y[::8, ::8].mean()))
+
+
+# --------------------------------------------------------------------------------
+def keep_luma(frame):
+    """ Analysis stream subscriber: keeps the luma of every 2nd pixel """
+    global streamLuma
+
+    streamLuma = frame.y[::2, ::2].copy()
+
+
+# --------------------------------------------------------------------------------
+
+
+def capture_luma():
+    """ Returns the luma of a low resolution frame for the timelapse fingerprint:
+    the latest frame of the analysis stream, or a FINGERPRINT_SIZE capture from
+    the video port on splitter port 2. None until the stream has a frame.
+    """
+    if analysisStream is not None:
+        return streamLuma
+    import numpy as np
+
+    width, height = FINGERPRINT_SIZE
+    output = io.BytesIO()
+    with cameraLock:
+        camera.capture(
+            output, "yuv", use_video_port=True, resize=FINGERPRINT_SIZE, splitter_port=2
+        )
+    fwidth, fheight = stream.padded(width, height)
+    y = np.frombuffer(output.getbuffer(), dtype=np.uint8, count=fwidth * fheight)
+    return y.reshape((fheight, fwidth))[:height, :width]
+
+
+# --------------------------------------------------------------------------------
+
+
+def capture_image(fname, use_video_port=False):
     """ This procedure will actually take the image and save the image as specified
     by fname
 
     Args:
-        fname   : The filename to save the image
+        fname           : The filename to save the image
+        use_video_port  : Take the image from the video port, next to a recording
     """
     logger.info("capture_image")
-    if camAnnotate:
-        camera.annotate_text = show_time()
-    logger.debug("image = {}".format(fname))
-    camera.capture(fname, imgFormat)
+    with cameraLock:
+        if camAnnotate:
+            camera.annotate_text = show_time()
+        logger.debug("image = {}".format(fname))
+        stream = io.BytesIO()
+        start = time.perf_counter()
+        camera.capture(stream, imgFormat, use_video_port=use_video_port)
+        captureSeconds.observe(time.perf_counter() - start)
+    submit(fname, stream)
 
 
 # --------------------------------------------------------------------------------
 
 
-def write_video(stream):
-    """ Write the entire content of the circular buffer to disk. No need to
-    lock the stream here as we're definitely not writing to it simultaneously.
+async def record_event(run, events, sequence, wait_active):
+    """ Records an event until there was no motion for vidPostRollSec seconds,
+    or for at most vidVideoTime seconds. The video is split in segments of
+    vidSegmentSec seconds or vidSegmentSize bytes, on the same recording.
+
+    Args:
+        run         : runloop.RunLoop
+        events      : recorder.EventRecorder which is recording
+        sequence    : Sequence number of the event
+        wait_active : Coroutine function(timeout) which returns True while
+                      there is motion
     """
-    logger.info("write_video")
-    with io.open("before.h264", "wb") as output:
-        for frame in stream.frames:
-            if frame.frame_type == picamera.PiVideoFrameType.sps_header:
-                stream.seek(frame.position)
-                break
-        while True:
-            buf = stream.read1()
-            if not buf:
-                break
-            output.write(buf)
-    # Wipe the circular stream once we're done
-    stream.seek(0)
-    stream.truncate()
+    logger.info("record_event")
+    name = str(sequence)
+    fileStr = (
+        videoDirs.path(sequence) + "/" + "mov" + "%s" + tlSuffix + "." + vidContainer
+    )
+    segment = 1
+    describe(fileStr % name)
+    await run.call(events.start_event, fileStr % name)
+    observe_trigger()
+    start = last = segmentStart = backend.monotonic()
+    while True:
+        camera.wait_recording(0)
+        if await wait_active(min(1, vidPostRollSec)):
+            last = backend.monotonic()
+        now = backend.monotonic()
+        if now - last >= vidPostRollSec:
+            break
+        if vidVideoTime and now - start >= vidVideoTime:
+            logger.debug("Maximum video length reached")
+            break
+        if (vidSegmentSec and now - segmentStart >= vidSegmentSec) or (
+            vidSegmentSize and events.event.size >= vidSegmentSize
+        ):
+            segment += 1
+            describe(fileStr % "{}-{}".format(name, segment))
+            await run.call(events.split_event, fileStr % "{}-{}".format(name, segment))
+            segmentStart = now
+    await run.call(events.end_event)
+    eventSeconds.observe(backend.monotonic() - start)
+    logger.debug("Event took {:.1f} sec.".format(backend.monotonic() - start))
+
+
+# --------------------------------------------------------------------------------
+
+
+def capture_burst(names):
+    """ Takes a burst of images from the video port at mtnBurstRate images per
+    second. The recording on the other splitter port continues.
+
+    Args:
+        names   : The filenames of the images
+    """
+    logger.info("capture_burst")
+    schedule = scheduler.DeadlineScheduler(1.0 / mtnBurstRate)
+
+    def outputs():
+        schedule.start()
+        for i, name in enumerate(names):
+            if i:
+                schedule.wait()
+            if camAnnotate:
+                camera.annotate_text = show_time()
+            stream = io.BytesIO()
+            yield stream
+            # The camera asks for the next output when this image is complete
+            submit(name, stream)
+
+    with cameraLock:
+        camera.capture_sequence(
+            outputs(), format=imgFormat, use_video_port=True, splitter_port=0
+        )
 
 
 ################################################################################
 # Main procedures
+#
+# Every modus is a task of the run loop (see runloop.py), so several modi can
+# run in one process. Blocking camera calls run in the thread pool of the loop.
 ################################################################################
 
 
-def start_test_image():
+async def start_test_image(run):
     """ This will make an image which can be used to position the camera and set
     the configuration.
     """
@@ -246,248 +499,799 @@ def start_test_image():
 
     global actionCount
 
-    init_camera()
     logger.debug("Making test image")
-    capture_image(fname("test"))
+    await run.call(capture_image, fname("test"), recording_modus())
     actionCount += 1
     logger.debug("Test image ended")
-    close_camera()
 
 
 # --------------------------------------------------------------------------------
 
 
-def start_timelapse():
+async def start_timelapse(run):
     """ This will take timelapse images. Images are stored with a sequence number.
+    The images are scheduled every tlTimeBetween sec. on a monotonic clock, so the
+    time to take an image does not add up. Below tlContinuousBelow sec. the images
+    are taken from the video port, which keeps the camera running in between.
+    Next to another modus the images are taken one by one, from the video port
+    when that modus records, and next to an image modus the names start with
+    "tl" + tlPrefix.
+    With tlSkipDuplicates an image is not taken when a low resolution frame is a
+    near-duplicate of the last kept image. Its sequence number is not reused, it
+    is recorded in the manifest SKIPPED_MANIFEST.
     """
-    global imageCount
     global actionCount
 
     logger.info("start_timelapse")
+    schedule = scheduler.DeadlineScheduler(tlTimeBetween, tlOverrun)
+    frames = None
+    prefix = tlPrefix
+    if any(m in appModi for m in (modus.MOTIONIMAGE, modus.PIRIMAGE)):
+        # The other modus numbers its images with the persistent sequence
+        prefix = "tl" + tlPrefix
+    duplicates = None
+    if tlSkipDuplicates:
+        duplicates = fingerprint.DuplicateFilter(
+            tlSkipThreshold,
+            tlSkipMax,
+            os.path.join(gbImageDir, SKIPPED_MANIFEST),
+        )
     try:
-        init_camera()
         logger.info(
             "This will take approx. {} sec.".format(tlTotalImages * tlTimeBetween)
         )
-        imageCount = 0
-        while imageCount < tlTotalImages:
-            capture_image(
-                fname(str(tlSequenceStart + imageCount).zfill(tlSequenceSize))
+        if tlTimeBetween < tlContinuousBelow and len(appModi) == 1:
+            logger.debug("Capturing continuously from the video port")
+            stream = io.BytesIO()
+            frames = camera.capture_continuous(
+                stream, format=imgFormat, use_video_port=True
             )
-            logger.debug(
-                "TimeLapse {} = {}".format(imageCount, tlSequenceStart + imageCount)
+        count = 0
+        schedule.start()
+        while count < tlTotalImages:
+            name = fname(
+                str(tlSequenceStart + count).zfill(tlSequenceSize),
+                tlSequenceStart + count,
+                prefix,
             )
-            imageCount += 1
-            actionCount += 1
-            # Takes roughly 6 seconds to take a picture
-            time.sleep(tlTimeBetween - procesTime)
-
-    except KeyboardInterrupt as e:
-        ctrl_c()
+            if duplicates is not None and await skip_duplicate(
+                run, duplicates, tlSequenceStart + count, name
+            ):
+                # The sequence number stays free, see the manifest
+                pass
+            elif frames is None:
+                await run.call(capture_image, name, recording_modus())
+                actionCount += 1
+            else:
+                if camAnnotate:
+                    camera.annotate_text = show_time()
+                await run.call(next, frames)
+                submit(name, stream.getvalue())
+                stream.seek(0)
+                stream.truncate()
+                actionCount += 1
+            logger.debug("TimeLapse {} = {}".format(count, tlSequenceStart + count))
+            count += 1
+            if count < tlTotalImages:
+                schedule.advance()
+                await run.sleep_until(schedule.deadline)
 
     finally:
+        if frames is not None:
+            frames.close()
+        if duplicates is not None:
+            duplicates.close()
+        schedule.log_statistics()
         logger.info("Timelapse has ended.")
-        close_camera()
 
 
 # --------------------------------------------------------------------------------
 
 
-def start_motion_image():
+async def skip_duplicate(run, duplicates, sequence, name):
+    """ Returns True when the timelapse image is skipped as a near-duplicate of
+    the last kept image, judged on a low resolution frame
+
+    Args:
+        run         : runloop.RunLoop
+        duplicates  : fingerprint.DuplicateFilter
+        sequence    : Sequence number of the image
+        name        : Filename of the image
+    """
+    y = await run.call(capture_luma)
+    if y is None:
+        return False
+    duplicate, distance = duplicates.check(y)
+    if duplicate:
+        duplicates.skip(sequence, name, distance)
+    return duplicate
+
+
+# --------------------------------------------------------------------------------
+
+
+async def start_motion_image(run):
+    """ This will take images after motion is detected. With mtnBurstCount > 0 a
+    burst of images is taken from the video port, while the recording and the
+    motion detection continue. With mtnBurstCount = 0 the recording is stopped
+    to take one image from the still port.
+    """
 
     logger.info("start_motion_image")
 
-    global motion_detected
-    global imageCount
     global actionCount
 
-    init_camera()
-    imageCount = 1
-    with detect_motion(camera) as output:
+    with motion_detector() as output:
+        # The pixel detector works on the analysis stream, without a recording
+        vectors = isinstance(output, detect_motion)
+        port = 1 if vectors else analysisStream.splitter_port
         try:
-            # record video to nowhere, as we are just trying to capture images:
-            camera.start_recording("/dev/null", format="h264", motion_output=output)
-            motion_detected = False
+            if vectors:
+                # record video to nowhere, as we are just trying to capture images:
+                await run.call(
+                    camera.start_recording,
+                    "/dev/null",
+                    format="h264",
+                    motion_output=output,
+                )
+            motion_event.clear()
+            log_startup("waiting for motion")
             logger.debug("Waiting for motion...")
             while True:
-                camera.wait_recording(mtnMinimumStillSec)
-                if motion_detected:
-                    logger.debug("Stop recording and capture an image...")
-                    camera.stop_recording()
-                    capture_image(None)
-                    imageCount += 1
+                camera.wait_recording(0, splitter_port=port)
+                if await wait_motion(run, mtnMinimumStillSec):
+                    if mtnBurstCount > 0:
+                        logger.debug("Capture {} images...".format(mtnBurstCount))
+                        names = []
+                        for i in range(mtnBurstCount):
+                            names.append(next_image())
+                        await run.call(capture_burst, names)
+                    elif vectors:
+                        logger.debug("Stop recording and capture an image...")
+                        await run.call(camera.stop_recording)
+                        await run.call(capture_image, next_image())
+                        await run.call(
+                            camera.start_recording,
+                            "/dev/null",
+                            format="h264",
+                            motion_output=output,
+                        )
+                    else:
+                        await run.call(capture_image, next_image())
                     actionCount += 1
-                    camera.start_recording(
-                        "/dev/null", format="h264", motion_output=output
-                    )
-                    motion_detected = False
+                    motion_event.clear()
                     logger.debug("Waiting for motion...")
 
-        except KeyboardInterrupt as e:
-            ctrl_c()
-
         finally:
+            if backend.recording(camera):
+                await run.call(camera.stop_recording)
             logger.info("Detect motion has ended.")
-            close_camera()
 
 
 # --------------------------------------------------------------------------------
 
 
-def start_motion_video():
+async def start_motion_video(run):
+    """ This will record a video after motion is detected. The video starts
+    vidPreRollSec seconds before the motion, from a circular buffer which is
+    recorded continuously, and continues while there is motion.
+    """
 
     logger.info("start_motion_video")
 
-    global motion_detected
-    global imageCount
     global actionCount
 
-    init_camera()
-    imageCount = 1
-    fileStr = gbVideoDir + "/" + "mov" + "%s" + tlSuffix + ".h264"
-    with detect_motion(camera) as output:
+    with motion_detector() as output:
+        if not isinstance(output, detect_motion):
+            # The pixel detector does not need the motion vectors
+            output = None
+        events = recorder.EventRecorder(
+            camera, vidPreRollSec, output, stored, vidContainer
+        )
         try:
-            # record video to nowhere, as we are just trying to capture images:
-            camera.start_recording("/dev/null", format="h264", motion_output=output)
-            motion_detected = False
+            await run.call(events.start)
+            motion_event.clear()
+            log_startup("waiting for motion")
             logger.debug("Waiting for motion...")
             while True:
-                camera.wait_recording(mtnMinimumStillSec)
-                if motion_detected:
+                camera.wait_recording(0)
+                if await wait_motion(run, mtnMinimumStillSec):
                     logger.debug("Recording video...")
-                    camera.stop_recording()
-                    camera.start_recording(fileStr % imageCount, format="h264")
-                    camera.wait_recording(vidVideoTime)
-                    camera.stop_recording()
-                    imageCount += 1
-                    actionCount += 1
-                    camera.start_recording(
-                        "/dev/null", format="h264", motion_output=output
+                    await record_event(
+                        run,
+                        events,
+                        videoSequence.next(),
+                        functools.partial(wait_motion, run),
                     )
-                    motion_detected = False
+                    actionCount += 1
+                    motion_event.clear()
                     logger.debug("Waiting for motion...")
 
-        except KeyboardInterrupt as e:
-            ctrl_c()
-
         finally:
+            if backend.recording(camera):
+                await run.call(events.stop)
             logger.debug("Detect motion has ended.")
-            close_camera()
 
 
 # --------------------------------------------------------------------------------
 
 
-def start_pir_image():
+async def start_pir_image(run):
+    """ This will take an image when the PIR is triggered. The GPIO pin raises an
+    interrupt, so this sleeps until the trigger instead of polling the pin.
+    """
 
     logger.info("start_pir_image")
 
-    global imageCount
     global actionCount
 
-    init_camera()
-    imageCount = 1
     try:
-        # Defining our default states so we can detect a change
-        prev_state = False
-        curr_state = False
+        log_startup("waiting for the PIR")
         logger.debug("Waiting for motion...")
         while True:
-            time.sleep(0.1)
-            prev_state = curr_state
-            # Map the state of the camera to our input pins (jumper cables connected to your PIR)
-            # curr_state = GPIO.input(pirSensorPin)
-            # Checking whether the state has changed
-            if curr_state != prev_state:
-                # Check if our new state is HIGH or LOW
-                new_state = "HIGH" if curr_state else "LOW"
-                logger.debug("GPIO pin {} is {}".format(pirSensorPin, new_state))
-                if (
-                    curr_state
-                ):  # State has changed to HIGH, so that must be a trigger from the PIR
-                    capture_image(None)
-                    imageCount += 1
-                    actionCount += 1
-
-    except KeyboardInterrupt as e:
-        KeyboardInterrupt()
+            if await wait_pir(run, 1):
+                set_trigger()
+                await run.call(capture_image, next_image(), recording_modus())
+                actionCount += 1
+                logger.debug("Waiting for motion...")
 
     finally:
         logger.debug("Detect PIR Image has ended.")
-        close_camera()
 
 
 # --------------------------------------------------------------------------------
 
 
-def start_pir_motion():
+async def start_pir_motion(run):
+    """ This will record a video when the PIR is triggered. The video starts
+    vidPreRollSec seconds before the trigger, from a circular buffer which is
+    recorded continuously, and continues while the PIR is active.
+    """
+
     logger.info("start_pir_motion")
 
+    global actionCount
+
+    events = recorder.EventRecorder(
+        camera, vidPreRollSec, on_close=stored, container=vidContainer
+    )
+    try:
+        await run.call(events.start)
+        log_startup("waiting for the PIR")
+        logger.debug("Waiting for motion...")
+        while True:
+            camera.wait_recording(0)
+            if await wait_pir(run, 1):
+                set_trigger()
+                logger.debug("Recording video...")
+                await record_event(
+                    run,
+                    events,
+                    videoSequence.next(),
+                    functools.partial(wait_pir_active, run),
+                )
+                actionCount += 1
+                logger.debug("Waiting for motion...")
+
+    finally:
+        if backend.recording(camera):
+            await run.call(events.stop)
+        logger.debug("Detect PIR Video has ended.")
+
 
 # ================================================================================
 # Helper functions
 # ================================================================================
 
 
-def fname(name):
+async def wait_motion(run, timeout):
+    """ Waits until detect_motion signals motion, returns True on motion and
+    resets the signal.
+
+    Args:
+        run     : runloop.RunLoop
+        timeout : Maximum seconds to wait
+    """
+    if await run.wait(motion_event, timeout):
+        motion_event.clear()
+        return True
+    return False
+
+
+# --------------------------------------------------------------------------------
+
+
+async def wait_pir(run, timeout):
+    """ Waits until the PIR is triggered, returns True when triggered
+
+    Args:
+        run     : runloop.RunLoop
+        timeout : Maximum seconds to wait
+    """
+    if await run.wait(pirSensor.triggered, timeout):
+        # Resets the trigger and records the latency
+        return pirSensor.wait(0)
+    return False
+
+
+# --------------------------------------------------------------------------------
+
+
+async def wait_pir_active(run, timeout):
+    """ Waits until the PIR is triggered, returns True when triggered or still
+    active
+    """
+    return await wait_pir(run, timeout) or pirSensor.active
+
+
+# --------------------------------------------------------------------------------
+
+
+def recording_modus():
+    """ Returns True when one of the modi records on the video port, so images
+    have to be taken from the video port as well
+    """
+    return any(m in appModi for m in RECORDING_MODI)
+
+
+# --------------------------------------------------------------------------------
+
+
+def open_pir():
+    global pirSensor
+
+    pirSensor = pir.open_pir(
+        appBackend,
+        pirSensorPin,
+        pirDebounceSec,
+        runloop.Trigger(),
+        interval=simPirInterval,
+        duration=simPirDuration,
+    )
+
+
+# --------------------------------------------------------------------------------
+
+
+def close_pir():
+    global pirSensor
+
+    if pirSensor is not None:
+        pirSensor.close()
+        pirSensor = None
+
+
+# --------------------------------------------------------------------------------
+
+
+def submit(path, data):
+    """ Hands a capture over to the writer
+
+    Args:
+        path    : Filename of the capture
+        data    : bytes or io.BytesIO with the capture
+    """
+    describe(path)
+    captureWriter.submit(path, data)
+    log_startup("first capture")
+
+
+# --------------------------------------------------------------------------------
+
+
+def describe(path):
+    """ Remembers the time and the motion of a capture for the catalogue """
+    if captureCatalogue is None:
+        return
+    name = taskModus.get() or "+".join(appModi)
+    if name == modus.MOTIONIMAGE or name == modus.MOTIONVIDEO:
+        captureInfo[path] = (name, time.time(), motionScore, motionBlobs)
+    else:
+        captureInfo[path] = (name, time.time(), None, None)
+
+
+# --------------------------------------------------------------------------------
+
+
+def stored(path, size):
+    """ Called when a capture is on disk """
+    if quotaManager is not None:
+        quotaManager.add(path, size)
+    if captureCatalogue is not None:
+        # Without the info of describe(), eg. a file of an earlier run, the
+        # capture is credited to all modi
+        name, when, score, blobs = captureInfo.pop(
+            path, ("+".join(appModi), None, None, None)
+        )
+        captureCatalogue.record(path, size, name, when, score, blobs)
+    if path.endswith(imgExtension):
+        observe_trigger()
+
+
+# --------------------------------------------------------------------------------
+
+
+def forget(path):
+    """ Called when a capture is dropped or could not be written """
+    captureInfo.pop(path, None)
+
+
+# --------------------------------------------------------------------------------
+
+
+def set_trigger():
+    """ Remembers the time of a trigger, unless an earlier one has no file yet """
+    global triggerTime
+
+    if triggerTime is None:
+        triggerTime = time.monotonic()
+
+
+# --------------------------------------------------------------------------------
+
+
+def observe_trigger():
+    """ Records the time since the trigger, when the first file is there """
+    global triggerTime
+
+    if triggerTime is not None:
+        triggerSeconds.observe(time.monotonic() - triggerTime)
+        triggerTime = None
+
+
+# --------------------------------------------------------------------------------
+
+
+def log_startup(what):
+    """ Logs the seconds from the start until the camera is ready, once per start
+
+    Args:
+        what    : What the camera is ready for
+    """
+    global startupTime
+
+    if startupTime is None:
+        startupTime = time.monotonic() - startTime
+        logger.info("Startup: {:.3f} sec. to {}".format(startupTime, what))
+
+
+# --------------------------------------------------------------------------------
+
+
+def fname(name, sequence=None, prefix=tlPrefix):
     logger.debug("fname")
-    return "{}/{}{}{}{}".format(gbImageDir, tlPrefix, name, tlSuffix, imgExtension)
+    return "{}/{}{}{}{}".format(
+        imageDirs.path(sequence), prefix, name, tlSuffix, imgExtension
+    )
+
+
+# --------------------------------------------------------------------------------
+
+
+def next_image():
+    """ Returns the filename for the next image of the persistent sequence """
+    global imageCount
+
+    imageCount = imageSequence.next()
+    return fname(str(imageCount).zfill(tlSequenceSize), imageCount)
 
 
 # ********************************************************************************
 
 
-class detect_motion(picamera.array.PiMotionAnalysis):
-    def analyse(self, a):
+class detect_motion(backend.MotionAnalysis):
+    def __init__(self, camera, size=None):
+        # numpy is only imported by the modi which detect motion
+        import motion
 
-        global motion_detected, last_still_capture_time
+        super().__init__(camera, size)
+        mask = None
+        if mtnRegions or mtnExclusions:
+            mask = motion.region_mask(
+                motion.motion_grid(camWidth, camHeight), mtnRegions, mtnExclusions
+            )
+            logger.debug(
+                "Motion detection on {} of {} macroblocks".format(mask.sum(), mask.size)
+            )
+        noise = None
+        if mtnNoiseModel:
+            noise = motion.NoiseModel(mtnNoiseAlpha, mtnNoiseSigma)
+        blobs = None
+        if mtnMinimumBlobSize > 0:
+            blobs = motion.BlobFinder(mtnMinimumBlobSize, mtnBlobBudget / camFrameRate)
+        self.scorer = motion.MotionScorer(
+            mtnMagnitude,
+            mtnMinimumVectors,
+            mtnMinimumStillSec,
+            backend.monotonic,
+            mask,
+            noise,
+            blobs,
+        )
+        self.last = None
+        self.vectors = None
+        if mtnVectorDir:
+            import motionlog
+
+            os.makedirs(mtnVectorDir, exist_ok=True)
+            name = datetime.datetime.now().strftime("vectors-%Y%m%d-%H%M%S.mvec")
+            self.vectors = motionlog.VectorWriter(
+                os.path.join(mtnVectorDir, name),
+                motion.motion_grid(*(size or camera.resolution)),
+                float(camera.framerate),
+                tuple(camera.resolution),
+            )
 
-        if datetime.datetime.now() > last_still_capture_time + datetime.timedelta(
-            seconds=mtnMinimumStillSec
-        ):
-            a = (
-                np.sqrt(
-                    np.square(a["x"].astype(np.float))
-                    + np.square(a["y"].astype(np.float))
+    def analyse(self, a):
+
+        global motionScore, motionBlobs
+
+        start = time.perf_counter()
+        now = backend.monotonic()
+        if self.last is not None:
+            # A gap of 2 or more frames means the frames in between were dropped
+            missed = int((now - self.last) * float(self.camera.framerate)) - 1
+            if missed > 0:
+                framesDropped.inc(missed)
+        self.last = now
+        framesTotal.inc()
+        if self.vectors is not None:
+            self.vectors.write(a)
+        if self.scorer.detect(a, now):
+            motionScore = self.scorer.count
+            motionBlobs = self.scorer.stats
+            logger.debug(
+                "Motion detected ({} vectors, {})".format(motionScore, motionBlobs)
+            )
+            motionTotal.inc()
+            set_trigger()
+            motion_event.set()
+        analyseSeconds.observe(time.perf_counter() - start)
+
+    def close(self):
+        blobs = self.scorer.blobs
+        if blobs is not None and blobs.frames:
+            logger.info(
+                "Blobs: {} frames, avg. {:.2f} ms, max. {:.2f} ms, {} over budget".format(
+                    blobs.frames,
+                    blobs.total_time / blobs.frames * 1000,
+                    blobs.max_time * 1000,
+                    blobs.over_budget,
                 )
-                .clip(0, 255)
-                .astype(np.uint8)
             )
-            # experiment with the following "if" as it may be too sensitive ???
-            # if there're more than 10 vectors with a magnitude greater than 60, then motion was detected:
-            if (a > mtnMagnitude).sum() > 10:
-                logger.debug("Motion detected")
-                motion_detected = True
+        if self.vectors is not None:
+            self.vectors.close()
+            self.vectors = None
+        super().close()
+
+
+# ********************************************************************************
+
+
+class detect_pixels:
+    """ Motion detection by frame difference on the luma of the analysis stream
+    (mtnDetector = "pixels"). Needs no H.264 recording.
+
+    Args:
+        stream  : stream.FrameStream to subscribe to
+    """
+
+    def __init__(self, stream):
+        import motion
+
+        self.stream = stream
+        width, height = stream.resolution
+        shape = (
+            (height + mtnPixelStep - 1) // mtnPixelStep,
+            (width + mtnPixelStep - 1) // mtnPixelStep,
+        )
+        mask = None
+        if mtnRegions or mtnExclusions:
+            mask = motion.pixel_mask(
+                shape, (camWidth, camHeight), mtnRegions, mtnExclusions
+            )
+        self.scorer = motion.FrameDifference(
+            mtnPixelThreshold,
+            mtnPixelCount,
+            mtnPixelAlpha,
+            mtnMinimumStillSec,
+            backend.monotonic,
+            mtnPixelStep,
+            mask,
+        )
+        self.last = None
+        stream.subscribe(self.analyse)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def analyse(self, frame):
+
+        global motionScore, motionBlobs
+
+        start = time.perf_counter()
+        if self.last is not None and frame.index - self.last > 1:
+            framesDropped.inc(frame.index - self.last - 1)
+        self.last = frame.index
+        framesTotal.inc()
+        if self.scorer.detect(frame.y, frame.time):
+            motionScore = self.scorer.count
+            motionBlobs = None
+            logger.debug("Motion detected ({} pixels)".format(motionScore))
+            motionTotal.inc()
+            set_trigger()
+            motion_event.set()
+        analyseSeconds.observe(time.perf_counter() - start)
+
+    def close(self):
+        self.stream.unsubscribe(self.analyse)
+
+
+# --------------------------------------------------------------------------------
+def motion_detector():
+    """ Returns the detector of mtnDetector: detect_motion, the motion_output of
+    the recording, or detect_pixels on the analysis stream
+    """
+    if mtnDetector == PIXELS:
+        return detect_pixels(analysisStream)
+    return detect_motion(camera)
 
 
-def main():
+# --------------------------------------------------------------------------------
+def modus_tasks(names):
+    """ Returns [(modus, coroutine function)] of the modi which run together, or
+    None when the combination is not valid. Only one modus can use the motion
+    detection or the recording, and only one the PIR.
+
+    Args:
+        names   : List of modi
+    """
+    tasks = {
+        modus.TESTIMAGE: start_test_image,
+        modus.TIMELAPSE: start_timelapse,
+        modus.MOTIONIMAGE: start_motion_image,
+        modus.MOTIONVIDEO: start_motion_video,
+        modus.PIRIMAGE: start_pir_image,
+        modus.PIRVIDEO: start_pir_motion,
+    }
+    for name in names:
+        if name not in tasks:
+            logger.error("Invalid modus: {}".format(name))
+            return None
+    if len(set(names)) < len(names):
+        logger.error("Modus used more than once: {}".format(names))
+        return None
+    if len([m for m in names if m in RECORDING_MODI]) > 1:
+        logger.error("Only one of {} can run at a time".format(RECORDING_MODI))
+        return None
+    if modus.PIRIMAGE in names and modus.PIRVIDEO in names:
+        logger.error("Only one PIR modus can run at a time")
+        return None
+    return [(name, tasks[name]) for name in names]
+
+
+# --------------------------------------------------------------------------------
+async def run_modus(run, name, task):
+    """ Runs a modus as a task of the run loop, the modus is in taskModus """
+    taskModus.set(name)
+    await task(run)
+
+
+# --------------------------------------------------------------------------------
+def restart(name, keep_camera=False):
+    """ Warm restart: runs another modus on the camera which was left open by
+    main(keep_camera=True), so the camera is not opened and started again.
+
+    Args:
+        name        : The modus to run
+        keep_camera : Leave the camera open for the next restart()
+    """
+    global appModus, startTime, startupTime
+
+    logger.info("restart {}".format(name))
+    appModus = name
+    startTime = time.monotonic()
+    startupTime = None
+    main(keep_camera)
+
+
+# --------------------------------------------------------------------------------
+
+
+def main(keep_camera=False):
+    """ Runs the modus appModus, or all modi of a list as tasks on one event loop
+
+    Args:
+        keep_camera : Leave the camera open for restart(). Default = False
+    """
 
     global imgExtension
+    global captureWriter
+    global imageDirs, videoDirs, imageSequence, videoSequence
+    global quotaManager
+    global captureCatalogue
+    global metricsServer
+    global appModi, runLoop
 
     logger.info("Starting {} {}".format(appName, appVersion))
     logger.info("Modus = {}".format(appModus))
-
+    if isinstance(appModus, (list, tuple)):
+        appModi = list(appModus)
+    else:
+        appModi = [appModus]
+    tasks = modus_tasks(appModi)
+    if tasks is None:
+        return
+
+    # this is useful when this program is started at boot via init.d
+    # or an upstart script, so it can be killed: i.e. kill some_pid:
+    signal.signal(signal.SIGTERM, signal_term_handler)
+    # kill -USR1 some_pid starts and stops the profiler
+    profiler.install(appProfileDir, appProfileInterval)
+    if appProfile:
+        profiler.start(appProfileDir, appProfileInterval)
+
+    if appMetricsPort and metricsServer is None:
+        try:
+            metricsServer = metrics.serve(appMetricsPort)
+        except OSError as e:
+            logger.error(
+                "Metrics not available on port {}: {}".format(appMetricsPort, e)
+            )
     check_folders()
+    imageDirs = storage.ShardedDirs(gbImageDir, gbShard, gbShardSize, tlSequenceSize)
+    videoDirs = storage.ShardedDirs(gbVideoDir, gbShard, gbShardSize, tlSequenceSize)
+    imageSequence = storage.SequenceCounter(
+        os.path.join(gbImageDir, ".sequence"), gbSequenceBlock
+    )
+    videoSequence = storage.SequenceCounter(
+        os.path.join(gbVideoDir, ".sequence"), gbSequenceBlock
+    )
 
     if imgFormat == "jpeg":
         imgExtension = ".jpg"
     else:
         imgExtension = "." + imgFormat
 
-    if appModus == modus.TESTIMAGE:
-        start_test_image()
-    elif appModus == modus.TIMELAPSE:
-        start_timelapse()
-    elif appModus == modus.MOTIONIMAGE:
-        start_motion_image()
-    elif appModus == modus.MOTIONVIDEO:
-        start_motion_video()
-    elif appModus == modus.PIRIMAGE:
-        start_pir_image()
-    elif appModus == modus.PIRVIDEO:
-        start_pir_motion()
-    else:
-        logger.error("Invalid modus: {}".format(appModus))
+    if gbQuotaBytes or gbMinFreeBytes:
+        quotaManager = storage.QuotaManager(
+            gbQuotaIndex, [gbImageDir, gbVideoDir], gbQuotaBytes, gbMinFreeBytes
+        )
+    if gbCatalogue:
+        captureCatalogue = catalogue.Catalogue(gbCatalogue)
+    captureWriter = writer.CaptureWriter(
+        gbWriterQueueSize, gbWriterThreads, gbWriterOverflow, stored, forget
+    )
+    try:
+        init_camera()
+        if modus.PIRIMAGE in appModi or modus.PIRVIDEO in appModi:
+            open_pir()
+        runLoop = runloop.RunLoop(len(tasks) + 2)
+        for name, task in tasks:
+            runLoop.add(name, run_modus(runLoop, name, task))
+        try:
+            runLoop.run()
+        except KeyboardInterrupt:
+            ctrl_c()
+    finally:
+        close_pir()
+        close_writer()
+        imageSequence.close()
+        videoSequence.close()
+        if quotaManager is not None:
+            quotaManager.close()
+            quotaManager = None
+        if captureCatalogue is not None:
+            captureCatalogue.close()
+            captureCatalogue = None
+        close_liveview()
+        close_stream()
+        profiler.stop()
+        if not keep_camera:
+            close_camera()
 
 
 # ********************************************************************************
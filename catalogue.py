@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Catalogue of the captures in an SQLite database.
+
+    Every image and video is recorded with its time, modus, file, size and the
+    motion which triggered it. Rows are inserted in batches by a background
+    thread, so capturing never waits for the database.
+
+    Usage: python3 catalogue.py DATABASE [--from TIME] [--to TIME]
+                                [--min-score N] [--modus MODUS] [--limit N]
+"""
+import argparse
+import datetime
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    id          INTEGER PRIMARY KEY,
+    time        REAL NOT NULL,
+    modus       TEXT NOT NULL,
+    path        TEXT NOT NULL,
+    size        INTEGER NOT NULL,
+    score       INTEGER,
+    blobs       INTEGER,
+    blob_area   INTEGER,
+    blob_x0     INTEGER,
+    blob_y0     INTEGER,
+    blob_x1     INTEGER,
+    blob_y1     INTEGER
+);
+CREATE INDEX IF NOT EXISTS captures_time ON captures (time);
+CREATE INDEX IF NOT EXISTS captures_score ON captures (score, time);
+"""
+
+COLUMNS = (
+    "time",
+    "modus",
+    "path",
+    "size",
+    "score",
+    "blobs",
+    "blob_area",
+    "blob_x0",
+    "blob_y0",
+    "blob_x1",
+    "blob_y1",
+)
+
+INSERT = "INSERT INTO captures ({}) VALUES ({})".format(
+    ", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))
+)
+
+
+# ********************************************************************************
+
+
+class Catalogue:
+    """ Inserts captures into the database in a background thread.
+
+    Args:
+        path        : Database file
+        batch       : Maximum number of rows per transaction
+        interval    : Maximum seconds a row waits before it is inserted
+    """
+
+    def __init__(self, path, batch=50, interval=1.0):
+        self.path = path
+        self.batch = batch
+        self.interval = interval
+        self.queue = queue.Queue()
+        # Statistics
+        self.inserted = 0
+        self.transactions = 0
+        self.errors = 0
+        self.ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="catalogue", daemon=True)
+        self._thread.start()
+        self.ready.wait()
+
+    def record(self, path, size, modus, when=None, score=None, blobs=None):
+        """ Adds a capture. Called from any thread, never blocks.
+
+        Args:
+            path    : Filename of the capture
+            size    : Size in bytes
+            modus   : Modus which made the capture
+            when    : Time of the capture (time.time()). Default = now
+            score   : Number of moving motion vectors. Default = None
+            blobs   : motion.BlobStats of the motion. Default = None
+        """
+        bbox = (blobs.bbox if blobs is not None else None) or (None,) * 4
+        self.queue.put(
+            (
+                time.time() if when is None else when,
+                modus,
+                path,
+                size,
+                score,
+                blobs.large if blobs is not None else None,
+                blobs.area if blobs is not None else None,
+            )
+            + tuple(bbox)
+        )
+
+    def close(self):
+        """ Inserts the remaining rows and stops the background thread """
+        self.queue.put(None)
+        self._thread.join()
+        logger.info(
+            "Catalogue: {} inserted in {} transactions, {} errors".format(
+                self.inserted, self.transactions, self.errors
+            )
+        )
+
+    def _run(self):
+        db = sqlite3.connect(self.path)
+        try:
+            db.executescript(SCHEMA)
+        finally:
+            self.ready.set()
+        stop = False
+        while not stop:
+            rows = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(rows) < self.batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if None in rows:
+                rows = [row for row in rows if row is not None]
+                stop = True
+            if rows:
+                self._insert(db, rows)
+        db.close()
+
+    def _insert(self, db, rows):
+        try:
+            with db:
+                db.executemany(INSERT, rows)
+        except sqlite3.Error as e:
+            if len(rows) == 1:
+                logger.error("Inserting {} failed: {}".format(rows[0], e))
+                self.errors += 1
+                return
+            # One bad row fails the batch: insert the rows one by one, so only
+            # the bad rows are lost
+            logger.warning(
+                "Inserting {} captures failed: {}, retrying one by one".format(
+                    len(rows), e
+                )
+            )
+            for row in rows:
+                self._insert(db, [row])
+            return
+        self.inserted += len(rows)
+        self.transactions += 1
+
+
+# --------------------------------------------------------------------------------
+def query(path, start=None, end=None, min_score=None, modus=None, limit=None):
+    """ Returns the captures as a list of dicts, oldest first
+
+    Args:
+        path        : Database file
+        start       : From this time (time.time() or datetime). Default = None
+        end         : Before this time (time.time() or datetime). Default = None
+        min_score   : Minimum motion score. Default = None
+        modus       : Only this modus. Default = None
+        limit       : Maximum number of captures. Default = None
+    """
+    where = []
+    args = []
+    for column, op, value in (
+        ("time", ">=", start),
+        ("time", "<", end),
+        ("score", ">=", min_score),
+        ("modus", "=", modus),
+    ):
+        if value is None:
+            continue
+        if isinstance(value, datetime.datetime):
+            value = value.timestamp()
+        where.append("{} {} ?".format(column, op))
+        args.append(value)
+    sql = "SELECT * FROM captures"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY time"
+    if limit:
+        sql += " LIMIT ?"
+        args.append(limit)
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    try:
+        return [dict(row) for row in db.execute(sql, args)]
+    finally:
+        db.close()
+
+
+# --------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Query the catalogue of captures")
+    parser.add_argument("database")
+    parser.add_argument(
+        "--from",
+        dest="start",
+        type=datetime.datetime.fromisoformat,
+        help='From this time, e.g. "2020-06-02 02:00"',
+    )
+    parser.add_argument(
+        "--to",
+        dest="end",
+        type=datetime.datetime.fromisoformat,
+        help="Before this time",
+    )
+    parser.add_argument("--min-score", type=int, help="Minimum motion score")
+    parser.add_argument("--modus", help="Only this modus")
+    parser.add_argument("--limit", type=int, help="Maximum number of captures")
+    args = parser.parse_args()
+
+    rows = query(
+        args.database, args.start, args.end, args.min_score, args.modus, args.limit
+    )
+    for row in rows:
+        print(
+            "{} {:<12} {:>6} {:>6} {:>10} {}".format(
+                datetime.datetime.fromtimestamp(row["time"]).strftime(
+                    "%Y-%m-%d %H:%M:%S"
+                ),
+                row["modus"],
+                "-" if row["score"] is None else row["score"],
+                "-" if row["blob_area"] is None else row["blob_area"],
+                row["size"],
+                row["path"],
+            )
+        )
+    print("{} captures".format(len(rows)))
+
+
+if __name__ == "__main__":
+    main()
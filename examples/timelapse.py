@@ -3,7 +3,6 @@
     Files are created as timelapse0000001.jpg till timelapse0000010.jpg
 """
 import logging
-import picamera
 import modus
 
 """
@@ -11,8 +10,24 @@ import modus
 """
 # Logging level. Default = logging.NOTSET
 appLoggingLevel = logging.NOTSET
-# Modus. Default = modus.TESTIMAGE
+# Modus, or a list of modi which run together, eg. [modus.TIMELAPSE, modus.MOTIONIMAGE].
+# Only one modus can use the motion detection or the recording. Default = modus.TESTIMAGE
 appModus = modus.TIMELAPSE
+# Camera backend: "picamera" or "simulated" (replay without a camera). Default = "picamera"
+appBackend = "picamera"
+# Port of the Prometheus metrics on http://localhost:PORT/metrics. 0 = off. Default = 9180
+appMetricsPort = 9180
+# Port of the MJPEG live view on http://HOST:PORT/, next to the running modus. 0 = off. Default = 0
+appLiveViewPort = 0
+# Size of the live view. Default = 640 x 480
+appLiveViewWidth = 640
+appLiveViewHeight = 480
+# Profile from the start. kill -USR1 PID starts and stops the profiler at any time. Default = False
+appProfile = False
+# Directory for the profiles (collapsed stacks for flamegraph.pl). Default = "./profiles"
+appProfileDir = "./profiles"
+# Seconds between the samples of the profiler. Default = 0.005
+appProfileInterval = 0.005
 
 """
     Global settings
@@ -23,20 +38,91 @@ gbImageDir = "./images"
 gbVideoDir = "./video"
 # Date/time format used in logging and annotation text. Default = "%Y-%m-%d %H:%M:%S"
 gbDateTimeFormat = "%Y-%m-%d %H:%M:%S"
+# Number of captured images in memory waiting to be written to disk. Default = 16
+gbWriterQueueSize = 16
+# Number of threads writing images to disk. Default = 1
+gbWriterThreads = 1
+# When the queue is full: "block" capturing, "drop_oldest" or "drop_newest" image. Default = "block"
+gbWriterOverflow = "block"
+# Store the files in subdirectories: "" = none, "date" = per day, "hour" = per hour,
+# "sequence" = per gbShardSize sequence numbers. Default = ""
+gbShard = ""
+# Number of sequence numbers per subdirectory with gbShard = "sequence". Default = 1000
+gbShardSize = 1000
+# Sequence numbers continue after a restart. They are reserved this many at a time
+# in the file .sequence in gbImageDir and gbVideoDir. Default = 100
+gbSequenceBlock = 100
+# Maximum bytes of all images and videos, the oldest are deleted first. 0 = no maximum. Default = 0
+gbQuotaBytes = 0
+# Minimum free bytes on the storage, the oldest images and videos are deleted first. 0 = no minimum. Default = 0
+gbMinFreeBytes = 0
+# Index of the images and videos for gbQuotaBytes and gbMinFreeBytes. Default = "./.quota"
+gbQuotaIndex = "./.quota"
+# SQLite database with all images and videos, see catalogue.py. "" = none. Default = "./catalogue.db"
+gbCatalogue = "./catalogue.db"
 
 """
     Motion settings
 """
 # Motion find compared with x sec. ago? Default = 1
 mtnMinimumStillSec = 1
-# If there're more than 10 vectors with a magnitude specified, then motion was detected. Default = 80
+# Magnitude of a motion vector to be counted as moving. Default = 80
 mtnMagnitude = 80
+# If there're more than this number of moving vectors, then motion was detected (unless mtnMinimumBlobSize is set). Default = 10
+mtnMinimumVectors = 10
+# Motion is detected when a connected blob of moving macroblocks (16x16 pixels) has at least this size,
+# instead of mtnMinimumVectors. 0 = off, count all moving vectors (mtnMinimumVectors). Default = 0
+mtnMinimumBlobSize = 0
+# Maximum time to find the blobs, as part of the time of a frame (1 / camFrameRate). Default = 0.25
+mtnBlobBudget = 0.25
+# Regions (in image coordinates) to detect motion in. Rectangles (x0, y0, x1, y1) and/or
+# polygons [(x, y), (x, y), ...]. Default = [] (whole image)
+mtnRegions = []
+# Regions (in image coordinates) to ignore, eg. trees or a road. Same format as mtnRegions. Default = []
+mtnExclusions = []
+# Learn the noise of every macroblock and only detect motion above it, eg. at night or in rain. Default = False
+mtnNoiseModel = False
+# Learning rate of the noise, 0..1. Default = 0.05
+mtnNoiseAlpha = 0.05
+# Motion must exceed the noise by this number of standard deviations. Default = 5
+mtnNoiseSigma = 5
+# Number of images taken from the video port after motion is detected. 0 = one image from the still port. Default = 0
+mtnBurstCount = 0
+# Images per second in a burst. Default = 2
+mtnBurstRate = 2
+# Directory to record the raw motion vectors to, for offline tuning with motionlog.py. "" = off. Default = ""
+mtnVectorDir = ""
+# Motion detector: "vectors" = motion vectors of the H.264 encoder, "pixels" = frame difference on the
+# analysis stream (camStreamWidth x camStreamHeight), which needs no recording. Default = "vectors"
+mtnDetector = "vectors"
+# pixels: A pixel is moving when its luma differs more than this from the background (0..255). Default = 25
+mtnPixelThreshold = 25
+# pixels: Motion is detected when more pixels than this are moving. Default = 100
+mtnPixelCount = 100
+# pixels: Learning rate of the background, 0..1. Default = 0.05
+mtnPixelAlpha = 0.05
+# pixels: Use every n-th pixel of the analysis stream in both directions. Default = 2
+mtnPixelStep = 2
+
+"""
+    Simulation settings, only used with appBackend = "simulated"
+"""
+# Recording directory with motion.npy, video.h264 and/or *.jpg. Default = None (generated)
+simSource = None
+# Replay speed, 1 = real time, 10 = 10 times faster. Default = 1
+simSpeed = 1
+# Seconds between simulated PIR triggers. Default = 30
+simPirInterval = 30
+# Seconds a simulated PIR trigger is active. Default = 3
+simPirDuration = 3
 
 """
     PIR settings
 """
 # Pin number on the GPIO port. Default = 11
 pirSensorPin = 11
+# Ignore PIR changes within this number of sec. after a change (debounce). Default = 0.2
+pirDebounceSec = 0.2
 
 """
     Camera settings
@@ -55,13 +141,18 @@ camHFlip = False
 camAnnotate = False
 # Default = 32
 camAnnotateTextSize = 32
-# Default = picamera.Color("#000000") (=black)
-camAnnotateBackground = picamera.Color("#000000")
-# Default = picamera.Color("#ffffff") (=white)
-camAnnotateForeground = picamera.Color("#ffffff")
+# Default = "#000000" (=black)
+camAnnotateBackground = "#000000"
+# Default = "#ffffff" (=white)
+camAnnotateForeground = "#ffffff"
 # Camera led on? Default = False
 camLed = False
 camFrameRate = 10
+# Low resolution raw YUV stream on splitter port 2, next to the recording, for analysis which needs pixels. Default = False
+camStream = False
+# Size of the analysis stream. Default = 320 x 240
+camStreamWidth = 320
+camStreamHeight = 240
 
 """
     Image settings
@@ -78,6 +169,16 @@ tlSequenceStart = 1
 tlTotalImages = 10
 # Time between each picture in seconds. Default = 10
 tlTimeBetween = 5
+# When taking an image overruns the next one: "skip" it or "catchup". Default = "skip"
+tlOverrun = "skip"
+# Take the images from the video port when tlTimeBetween is below this number of sec. Default = 2
+tlContinuousBelow = 2
+# Skip timelapse images which are near-duplicates of the last kept image, judged on a low resolution frame before the image is taken. Default = False
+tlSkipDuplicates = False
+# Near-duplicate: the mean brightness (0..255) of no 1/64 of the image differs more than this. Default = 8
+tlSkipThreshold = 8
+# Keep an image after this number of skipped images, 0 = no limit. Default = 0
+tlSkipMax = 0
 # Prefix for image filename. Default = "img"
 tlPrefix = "timelapse"
 # Suffix for image filename. Default = ""
@@ -88,5 +189,15 @@ tlSequenceSize = 7
 """
     Video settings
 """
-# Length of the video after motion detected in sec. Default = 30
-vidVideoTime = 30
+# Maximum length of the video after motion detected in sec., 0 = as long as there is motion. Default = 300
+vidVideoTime = 300
+# Continue recording until there was no motion for this number of sec. Default = 5
+vidPostRollSec = 5
+# Split the video in files of this number of sec., 0 = no split. Default = 60
+vidSegmentSec = 60
+# Split the video in files of this number of bytes, 0 = no split. Default = 0
+vidSegmentSize = 0
+# Seconds of video before the motion, kept in memory (approx. 2 MB per sec.). Default = 5
+vidPreRollSec = 5
+# File format of the videos: "h264" (raw H.264) or "mp4" (remuxed while recording). Default = "mp4"
+vidContainer = "mp4"
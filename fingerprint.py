@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Perceptual fingerprint of a low resolution frame, to skip near-duplicate
+    timelapse images before the full image is encoded.
+
+    The fingerprint is the mean luma of 8 x 8 blocks of the frame, 64 bytes.
+    Sensor noise averages out in the blocks, a change of the scene or of the
+    light changes one or more blocks. The distance of two fingerprints is the
+    largest difference of a block, so a small change is not diluted by the
+    rest of the frame. A slow change, like dawn, adds up against the last kept
+    frame until it passes the threshold.
+
+    numpy is imported when the first fingerprint is taken.
+"""
+import logging
+import time
+import metrics
+
+logger = logging.getLogger(__name__)
+
+skippedTotal = metrics.counter(
+    "camera_timelapse_skipped_total", "Timelapse images skipped as near-duplicates"
+)
+
+
+# --------------------------------------------------------------------------------
+def fingerprint(y, size=8):
+    """ Returns the mean luma of size x size blocks of a frame, uint8
+
+    Args:
+        y       : Luma, uint8 array (height, width), at least (size, size)
+        size    : Blocks per row and column. Default = 8
+    """
+    import numpy as np
+
+    height, width = y.shape
+    # The remainder of the rows and columns is cut off
+    rows = height // size
+    cols = width // size
+    blocks = (
+        y[: rows * size, : cols * size]
+        .reshape(size, rows, size, cols)
+        .mean(axis=(1, 3), dtype=np.float32)
+    )
+    return np.rint(blocks).astype(np.uint8)
+
+
+# --------------------------------------------------------------------------------
+def distance(a, b):
+    """ Returns the largest difference of a block of the fingerprints a and b """
+    return int(abs(a.astype(int) - b).max())
+
+
+# ********************************************************************************
+
+
+class DuplicateFilter:
+    """ Decides which frames of a timelapse are near-duplicates of the last kept
+    frame. A skipped frame is recorded in the manifest, a CSV file with the
+    sequence number and the name the image would have had.
+
+    Args:
+        threshold   : Skip when no block differs more than this from the last
+                      kept frame
+        max_skipped : Keep a frame after this number of skipped frames, 0 = no
+                      limit
+        manifest    : Path of the manifest. Default = None (no manifest)
+    """
+
+    def __init__(self, threshold=8, max_skipped=0, manifest=None):
+        self.threshold = threshold
+        self.max_skipped = max_skipped
+        self.last = None
+        self._manifest = None
+        if manifest:
+            self._manifest = open(manifest, "a", buffering=1)
+            if self._manifest.tell() == 0:
+                self._manifest.write("sequence,name,time,distance\n")
+        self._run = 0
+        # Statistics
+        self.kept = 0
+        self.skipped = 0
+        self.seconds = 0.0
+
+    def check(self, y):
+        """ Returns (duplicate, distance) of a frame to the last kept frame. A
+        frame which is not a duplicate becomes the last kept frame.
+
+        Args:
+            y   : Luma of the low resolution frame
+        """
+        start = time.perf_counter()
+        current = fingerprint(y)
+        self.seconds += time.perf_counter() - start
+        if self.last is None:
+            self.last = current
+            self.kept += 1
+            return False, None
+        d = distance(current, self.last)
+        duplicate = d <= self.threshold
+        if duplicate and self.max_skipped and self._run >= self.max_skipped:
+            duplicate = False
+        if duplicate:
+            self._run += 1
+            self.skipped += 1
+            skippedTotal.inc()
+        else:
+            self._run = 0
+            self.kept += 1
+            self.last = current
+        return duplicate, d
+
+    def skip(self, sequence, name, distance):
+        """ Records a skipped frame in the manifest
+
+        Args:
+            sequence    : Sequence number of the frame
+            name        : Filename the image would have had
+            distance    : Distance to the last kept frame
+        """
+        logger.debug("Skipped {}, distance {}".format(name, distance))
+        if self._manifest is not None:
+            self._manifest.write(
+                "{},{},{:.3f},{}\n".format(sequence, name, time.time(), distance)
+            )
+
+    def close(self):
+        if self._manifest is not None:
+            self._manifest.close()
+            self._manifest = None
+        checked = self.kept + self.skipped
+        if checked:
+            logger.info(
+                "Duplicates: {} kept, {} skipped, {:.2f} ms per fingerprint".format(
+                    self.kept, self.skipped, self.seconds / checked * 1000
+                )
+            )
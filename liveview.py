@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    MJPEG live view over HTTP, to check the framing while a modus is running.
+
+    The camera encodes MJPEG on its own splitter port, only while a viewer is
+    connected. Each frame is one bytes object, shared by reference by all
+    clients. A client gets the latest frame when it is ready for the next one:
+    a slow client skips frames instead of buffering them, and nothing waits for
+    a client in the encoder callback.
+
+        http://HOST:PORT/               Page with the live view
+        http://HOST:PORT/stream.mjpg    multipart/x-mixed-replace stream
+"""
+import asyncio
+import io
+import logging
+import threading
+import metrics
+
+BOUNDARY = b"FRAME"
+PAGE = b"""<html><head><title>Camera</title></head>
+<body style="margin:0;background:#000"><img src="stream.mjpg" style="width:100%"></body>
+</html>
+"""
+
+logger = logging.getLogger(__name__)
+
+clientsGauge = metrics.gauge("camera_liveview_clients", "Connected live view clients")
+sentTotal = metrics.counter("camera_liveview_frames_total", "Live view frames sent")
+skippedTotal = metrics.counter(
+    "camera_liveview_skipped_total", "Live view frames skipped for slow clients"
+)
+
+
+# ********************************************************************************
+
+
+class LiveView(io.IOBase):
+    """ HTTP server of the MJPEG live view. serve() runs it on an asyncio event
+    loop, start() runs it in a thread with its own event loop.
+
+    Args:
+        camera          : PiCamera or backend.SimulatedCamera
+        port            : TCP port
+        host            : Address to listen on. Default = all interfaces
+        resolution      : (width, height) of the live view
+        splitter_port   : Splitter port, not used otherwise. Default = 3
+    """
+
+    def __init__(
+        self, camera, port, host="0.0.0.0", resolution=(640, 480), splitter_port=3
+    ):
+        super().__init__()
+        self.camera = camera
+        self.port = port
+        self.host = host
+        self.resolution = tuple(resolution)
+        self.splitter_port = splitter_port
+        self.frame = None
+        self.index = 0
+        self._buffer = bytearray()
+        self._clients = set()
+        self._handlers = {}
+        self._closing = False
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._recording = False
+        self._lock = None
+
+    # The encoder side, called in the encoder thread
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        """ Called by the encoder. A frame may arrive in more than one write """
+        self._buffer += b
+        if self._buffer[-2:] == b"\xff\xd9":
+            # End of image: in the entropy coded data 0xff is followed by 0x00
+            frame = bytes(self._buffer)
+            self._buffer.clear()
+            self._loop.call_soon_threadsafe(self._publish, frame)
+        return len(b)
+
+    # The event loop side
+
+    def _publish(self, frame):
+        self.frame = frame
+        self.index += 1
+        for event in self._clients:
+            event.set()
+
+    async def serve(self):
+        """ Serves until the task is cancelled """
+        self._loop = asyncio.get_running_loop()
+        self._lock = asyncio.Lock()
+        self._closing = False
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info("Live view on http://{}:{}/".format(self.host, self.port))
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        finally:
+            # Wake up and disconnect the clients
+            self._closing = True
+            for event in self._clients:
+                event.set()
+            for writer in self._handlers.values():
+                writer.transport.abort()
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+            await self._stop_recording()
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._handlers[task] = writer
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.split()
+            path = parts[1].decode("latin-1") if len(parts) > 1 else ""
+            if path in ("/", "/index.html"):
+                writer.write(
+                    b"HTTP/1.0 200 OK\r\nContent-Type: text/html\r\n"
+                    b"Content-Length: %d\r\n\r\n" % len(PAGE) + PAGE
+                )
+            elif path == "/stream.mjpg":
+                await self._stream(writer)
+            else:
+                writer.write(b"HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            del self._handlers[task]
+
+    async def _stream(self, writer):
+        peer = writer.get_extra_info("peername")
+        logger.info("Live view client {} connected".format(peer))
+        writer.write(
+            b"HTTP/1.0 200 OK\r\nCache-Control: no-cache, private\r\n"
+            b"Content-Type: multipart/x-mixed-replace; boundary="
+            + BOUNDARY
+            + b"\r\n\r\n"
+        )
+        event = asyncio.Event()
+        self._clients.add(event)
+        clientsGauge.set(len(self._clients))
+        last = self.index
+        try:
+            await self._start_recording()
+            while True:
+                await event.wait()
+                event.clear()
+                if self._closing:
+                    break
+                frame = self.frame
+                if self.index - last > 1:
+                    skippedTotal.inc(self.index - last - 1)
+                last = self.index
+                writer.writelines(
+                    (
+                        b"--" + BOUNDARY + b"\r\nContent-Type: image/jpeg\r\n"
+                        b"Content-Length: %d\r\n\r\n" % len(frame),
+                        frame,
+                        b"\r\n",
+                    )
+                )
+                # Frames published meanwhile replace each other in self.frame
+                await writer.drain()
+                sentTotal.inc()
+        finally:
+            self._clients.discard(event)
+            clientsGauge.set(len(self._clients))
+            logger.info("Live view client {} disconnected".format(peer))
+            if not self._clients:
+                await self._stop_recording()
+
+    async def _start_recording(self):
+        async with self._lock:
+            if not self._recording:
+                await self._loop.run_in_executor(
+                    None,
+                    lambda: self.camera.start_recording(
+                        self,
+                        format="mjpeg",
+                        resize=self.resolution,
+                        splitter_port=self.splitter_port,
+                    ),
+                )
+                self._recording = True
+
+    async def _stop_recording(self):
+        async with self._lock:
+            if self._recording:
+                self._recording = False
+                await self._loop.run_in_executor(
+                    None,
+                    lambda: self.camera.stop_recording(
+                        splitter_port=self.splitter_port
+                    ),
+                )
+                self._buffer.clear()
+
+    # Running in a thread
+
+    def start(self):
+        """ Runs serve() in a thread with its own event loop """
+        loop = asyncio.new_event_loop()
+        self._task = loop.create_task(self.serve())
+        self._thread = threading.Thread(
+            target=self._run, args=(loop,), name="liveview", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, loop):
+        try:
+            loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception("Live view failed")
+        finally:
+            loop.close()
+
+    def stop(self):
+        """ Stops the server and the recording, started by start() """
+        if self._thread is not None:
+            self._task.get_loop().call_soon_threadsafe(self._task.cancel)
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Counters, gauges and histograms of the hot paths, served in the Prometheus
+    text format on a localhost HTTP endpoint.
+
+    Recording a value is a lock, an addition and, for a histogram, a bisect in
+    a few fixed buckets, so the metrics can stay on in production.
+
+    http.server is imported when the endpoint is served.
+"""
+import bisect
+import logging
+import threading
+
+# Buckets in seconds for latencies from 100 us to 10 sec.
+LATENCY = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+logger = logging.getLogger(__name__)
+
+_registry = []
+_lock = threading.Lock()
+
+
+# ********************************************************************************
+
+
+class Counter:
+    """ Value which only goes up
+
+    Args:
+        name    : Metric name, ending in _total
+        help    : Description
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+
+# ********************************************************************************
+
+
+class Gauge:
+    """ Value which goes up and down, set or read from a function
+
+    Args:
+        name    : Metric name
+        help    : Description
+        func    : Function which returns the value. Default = None (use set())
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, func=None):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield self.name, self.func() if self.func is not None else self.value
+
+
+# ********************************************************************************
+
+
+class Histogram:
+    """ Distribution of values over fixed buckets
+
+    Args:
+        name    : Metric name
+        help    : Description
+        buckets : Upper bounds of the buckets, ascending
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            yield '{}_bucket{{le="{}"}}'.format(self.name, bound), cumulative
+        yield '{}_bucket{{le="+Inf"}}'.format(self.name), count
+        yield "{}_sum".format(self.name), total
+        yield "{}_count".format(self.name), count
+
+
+# --------------------------------------------------------------------------------
+def _register(metric):
+    with _lock:
+        for existing in _registry:
+            if existing.name == metric.name:
+                return existing
+        _registry.append(metric)
+    return metric
+
+
+# --------------------------------------------------------------------------------
+def counter(name, help):
+    """ Returns the registered Counter name, created when needed """
+    return _register(Counter(name, help))
+
+
+# --------------------------------------------------------------------------------
+def gauge(name, help, func=None):
+    """ Returns the registered Gauge name, created when needed """
+    metric = _register(Gauge(name, help, func))
+    if func is not None:
+        metric.func = func
+    return metric
+
+
+# --------------------------------------------------------------------------------
+def histogram(name, help, buckets=LATENCY):
+    """ Returns the registered Histogram name, created when needed """
+    return _register(Histogram(name, help, buckets))
+
+
+# --------------------------------------------------------------------------------
+def render():
+    """ Returns all metrics in the Prometheus text format """
+    lines = []
+    with _lock:
+        registry = list(_registry)
+    for metric in registry:
+        lines.append("# HELP {} {}".format(metric.name, metric.help))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        for name, value in metric.samples():
+            lines.append("{} {}".format(name, value))
+    return "\n".join(lines) + "\n"
+
+
+# --------------------------------------------------------------------------------
+def serve(port, host="127.0.0.1"):
+    """ Serves /metrics in a background thread, returns the server
+
+    Args:
+        port    : TCP port
+        host    : Address to listen on. Default = localhost only
+    """
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logger.info("Metrics on http://{}:{}/metrics".format(host, port))
+    return server
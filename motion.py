@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Motion scoring for the motion vectors delivered by the H.264 encoder, and
+    for grayscale frames of the analysis stream (frame difference)
+"""
+import time
+import numpy as np
+
+# Data type of the motion vectors as delivered by picamera.array.PiMotionArray
+MOTION_DTYPE = np.dtype([("x", "i1"), ("y", "i1"), ("sad", "u2")])
+
+
+# --------------------------------------------------------------------------------
+def motion_grid(width, height):
+    """ Returns the shape (rows, cols) of the motion vector array for a resolution.
+    The encoder works on 16x16 macroblocks and adds one extra column.
+    """
+    return ((height + 15) // 16, (width + 15) // 16 + 1)
+
+
+# --------------------------------------------------------------------------------
+def region_mask(shape, regions=None, exclusions=None):
+    """ Rasterizes regions into a boolean mask over the motion vector grid. A
+    macroblock is inside a region when its centre is.
+
+    Args:
+        shape       : Shape (rows, cols) of the motion vector grid
+        regions     : Rectangles (x0, y0, x1, y1) and/or polygons [(x, y), ...] in
+                      image coordinates to detect motion in. Default = whole image
+        exclusions  : Rectangles and/or polygons to ignore
+    """
+    rows, cols = shape
+    # Centres of the macroblocks in image coordinates. The last column of the
+    # grid is not a macroblock.
+    y, x = np.mgrid[0:rows, 0 : cols - 1] * 16 + 8
+    mask = np.zeros(shape, dtype=np.bool_)
+    mask[:, :-1] = _rasterize(x, y, regions, exclusions)
+    return mask
+
+
+# --------------------------------------------------------------------------------
+def pixel_mask(shape, resolution, regions=None, exclusions=None):
+    """ Rasterizes regions into a boolean mask over a (downscaled) frame. A
+    pixel is inside a region when its centre is.
+
+    Args:
+        shape       : Shape (rows, cols) of the frame
+        resolution  : (width, height) of the image the regions refer to
+        regions     : As region_mask
+        exclusions  : As region_mask
+    """
+    rows, cols = shape
+    width, height = resolution
+    y, x = np.mgrid[0:rows, 0:cols] + 0.5
+    return _rasterize(x * width / cols, y * height / rows, regions, exclusions)
+
+
+# --------------------------------------------------------------------------------
+def _rasterize(x, y, regions, exclusions):
+    if regions:
+        inside = np.zeros(x.shape, dtype=np.bool_)
+        for region in regions:
+            inside |= _inside(region, x, y)
+    else:
+        inside = np.ones(x.shape, dtype=np.bool_)
+    for region in exclusions or []:
+        inside &= ~_inside(region, x, y)
+    return inside
+
+
+# --------------------------------------------------------------------------------
+def _inside(region, x, y):
+    if len(region) == 4 and not hasattr(region[0], "__len__"):
+        x0, y0, x1, y1 = region
+        return (
+            (x >= min(x0, x1))
+            & (x < max(x0, x1))
+            & (y >= min(y0, y1))
+            & (y < max(y0, y1))
+        )
+    # Polygon, even-odd rule: count the edges crossed by a ray to the right
+    inside = np.zeros(x.shape, dtype=np.bool_)
+    points = list(region)
+    for (xa, ya), (xb, yb) in zip(points, points[1:] + points[:1]):
+        if ya == yb:
+            continue
+        crosses = (y >= min(ya, yb)) & (y < max(ya, yb))
+        crosses &= x < xa + (y - ya) * (xb - xa) / (yb - ya)
+        inside ^= crosses
+    return inside
+
+
+# ********************************************************************************
+
+
+class NoiseModel:
+    """ Learns the noise of the vector magnitude per macroblock, as an
+    exponential moving average of the mean and the variance in float32 arrays.
+    A macroblock only moves when it exceeds its own baseline by sigma standard
+    deviations. The baseline is learned from the macroblocks within the noise,
+    and with a fraction of the learning rate from the moving macroblocks, so it
+    follows a lasting rise of the noise, like rain or a higher gain.
+    All work is done in place, O(grid) per frame.
+
+    Args:
+        alpha   : Learning rate, 0..1
+        sigma   : Number of standard deviations above the mean to be moving
+        slow    : Fraction of alpha for the moving macroblocks. Default = 0.05
+    """
+
+    def __init__(self, alpha=0.05, sigma=5.0, slow=0.05):
+        self.alpha = alpha
+        self.sigma = sigma
+        self.slow = slow
+        self.frames = 0
+        self._shape = None
+
+    def _allocate(self, shape):
+        self._shape = shape
+        self.frames = 0
+        self.mean = np.zeros(shape, dtype=np.float32)
+        self.var = np.zeros(shape, dtype=np.float32)
+        self._mag = np.empty(shape, dtype=np.float32)
+        self._diff = np.empty(shape, dtype=np.float32)
+        self._tmp = np.empty(shape, dtype=np.float32)
+        self._rate = np.empty(shape, dtype=np.float32)
+        self._flag = np.empty(shape, dtype=np.bool_)
+
+    def classify(self, sq, moving):
+        """ Clears the moving macroblocks which are within the noise and learns
+        the noise, mostly from them.
+
+        Args:
+            sq      : Squared magnitudes of the vectors
+            moving  : Boolean array, updated in place
+        """
+        if sq.shape != self._shape:
+            self._allocate(sq.shape)
+        diff = self._diff
+        tmp = self._tmp
+        rate = self._rate
+        flag = self._flag
+        np.sqrt(sq, out=self._mag)
+        np.subtract(self._mag, self.mean, out=diff)
+        np.sqrt(self.var, out=tmp)
+        np.multiply(tmp, self.sigma, out=tmp)
+        np.greater(diff, tmp, out=flag)
+        np.logical_and(moving, flag, out=moving)
+        # Plain average of everything until the baseline is filled, then an
+        # exponential average, slow for the macroblocks above the noise
+        self.frames += 1
+        alpha = 1.0 / self.frames
+        if alpha > self.alpha:
+            rate.fill(alpha)
+        else:
+            rate.fill(self.alpha * self.slow)
+            np.logical_not(flag, out=flag)
+            np.copyto(rate, self.alpha, where=flag)
+        # var = (1 - rate) * (var + rate * diff^2), mean += rate * diff
+        step = self._mag
+        np.multiply(diff, rate, out=step)
+        np.multiply(diff, step, out=tmp)
+        np.add(tmp, self.var, out=tmp)
+        np.multiply(tmp, rate, out=diff)
+        np.subtract(tmp, diff, out=self.var)
+        np.add(self.mean, step, out=self.mean)
+
+
+# ********************************************************************************
+
+
+class BlobStats:
+    """ Connected blobs of moving macroblocks in a frame
+
+    Attributes:
+        count       : Number of blobs
+        large       : Number of blobs of at least the minimum size
+        area        : Macroblocks in the largest blob
+        bbox        : Bounding box (x0, y0, x1, y1) of the largest blob in image
+                      coordinates, or None
+        complete    : False when the time budget ran out, blobs may be split
+        elapsed     : Seconds spent
+    """
+
+    __slots__ = ("count", "large", "area", "bbox", "complete", "elapsed")
+
+    def __init__(self):
+        self.count = 0
+        self.large = 0
+        self.area = 0
+        self.bbox = None
+        self.complete = True
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return "BlobStats(count={}, large={}, area={}, bbox={})".format(
+            self.count, self.large, self.area, self.bbox
+        )
+
+
+# ********************************************************************************
+
+
+class BlobFinder:
+    """ Finds the 4-connected blobs of moving macroblocks with NumPy only.
+
+    Every macroblock starts with its own label, then labels propagate to the
+    maximum of the neighbours and jump to the label of the macroblock they point
+    to, until nothing changes. Each step is a few vectorized operations on
+    preallocated buffers. The pass stops when the time budget runs out.
+
+    Args:
+        min_size    : Minimum number of macroblocks of a blob to count as large
+        budget      : Maximum seconds per frame. Default = None (no limit)
+    """
+
+    def __init__(self, min_size=1, budget=None):
+        self.min_size = min_size
+        self.budget = budget
+        self.stats = None
+        # Statistics
+        self.frames = 0
+        self.over_budget = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self._shape = None
+
+    def _allocate(self, shape):
+        self._shape = shape
+        size = shape[0] * shape[1]
+        self._index = np.arange(1, size + 1, dtype=np.int32).reshape(shape)
+        self._labels = np.empty(shape, dtype=np.int32)
+        self._prev = np.empty(shape, dtype=np.int32)
+        self._tmp = np.empty(shape, dtype=np.int32)
+        # Label 0 (not moving) points to itself
+        self._lookup = np.zeros(size + 1, dtype=np.int32)
+        self._flag = np.empty(shape, dtype=np.bool_)
+
+    def _label(self, moving, window, start):
+        index = self._index[window]
+        labels = self._labels[window]
+        prev = self._prev[window]
+        tmp = self._tmp[window]
+        flag = self._flag[window]
+        np.multiply(index, moving, out=labels)
+        while True:
+            np.copyto(prev, labels)
+            # Propagate the largest label of the 4 neighbours
+            np.maximum(labels[1:], prev[:-1], out=labels[1:])
+            np.maximum(labels[:-1], prev[1:], out=labels[:-1])
+            np.maximum(labels[:, 1:], prev[:, :-1], out=labels[:, 1:])
+            np.maximum(labels[:, :-1], prev[:, 1:], out=labels[:, :-1])
+            np.multiply(labels, moving, out=labels)
+            # Jump to the label of the macroblock the label points to
+            self._lookup[index] = labels
+            np.take(self._lookup, labels, out=tmp)
+            np.maximum(labels, tmp, out=labels)
+            np.not_equal(labels, prev, out=flag)
+            if not flag.any():
+                break
+            if self.budget and time.perf_counter() - start > self.budget:
+                self.stats.complete = False
+                self.over_budget += 1
+                break
+
+    def _measure(self, window, origin):
+        stats = self.stats
+        labels = self._labels[window]
+        flag = self._flag[window]
+        # Every blob ends up with the label of its last macroblock
+        np.equal(labels, self._index[window], out=flag)
+        stats.count = int(np.count_nonzero(flag))
+        areas = np.bincount(labels.reshape(-1))
+        areas[0] = 0
+        label = int(areas.argmax())
+        stats.area = int(areas[label])
+        stats.large = int(np.count_nonzero(areas >= self.min_size))
+        np.equal(labels, label, out=flag)
+        rows = np.flatnonzero(flag.any(axis=1)) + origin[0]
+        cols = np.flatnonzero(flag.any(axis=0)) + origin[1]
+        stats.bbox = (
+            int(cols[0]) * 16,
+            int(rows[0]) * 16,
+            (int(cols[-1]) + 1) * 16,
+            (int(rows[-1]) + 1) * 16,
+        )
+
+    def find(self, moving, origin=(0, 0)):
+        """ Returns the BlobStats of the moving macroblocks.
+
+        Args:
+            moving  : Boolean array over the motion vector grid
+            origin  : (row, col) of moving in the full grid
+        """
+        start = time.perf_counter()
+        if moving.shape != self._shape:
+            self._allocate(moving.shape)
+        stats = self.stats = BlobStats()
+        rows = np.flatnonzero(moving.any(axis=1))
+        if len(rows):
+            # Only work on the rows and columns with moving macroblocks
+            cols = np.flatnonzero(moving.any(axis=0))
+            r0, c0 = int(rows[0]), int(cols[0])
+            window = (slice(r0, int(rows[-1]) + 1), slice(c0, int(cols[-1]) + 1))
+            self._label(moving[window], window, start)
+            self._measure(window, (origin[0] + r0, origin[1] + c0))
+        stats.elapsed = time.perf_counter() - start
+        self.frames += 1
+        self.total_time += stats.elapsed
+        self.max_time = max(self.max_time, stats.elapsed)
+        return stats
+
+
+# ********************************************************************************
+
+
+class MotionScorer:
+    """ Scores the motion vectors of a frame without allocating memory per frame.
+
+    The squared magnitude of each vector is compared with the squared threshold,
+    so neither floating point nor a square root is needed. As in the original
+    uint8(sqrt(x^2 + y^2)) > magnitude, the magnitude is truncated: a vector is
+    moving when x^2 + y^2 >= (magnitude + 1)^2. After motion is
+    detected, frames are skipped for still_sec seconds (monotonic clock).
+
+    With a mask (see region_mask) only the macroblocks in the mask count. The
+    rows and columns outside the mask are not processed at all, also between
+    regions. A blob finder needs the neighbours, with one the whole bounding
+    box of the mask is processed. With a noise model (see NoiseModel) the
+    macroblocks must also exceed their own baseline. With a blob finder (see BlobFinder) motion is detected when a connected blob
+    of moving macroblocks has at least the minimum size, instead of counting
+    the moving vectors.
+
+    Args:
+        magnitude   : A vector is moving when its magnitude is larger than this
+        vectors     : Motion is detected when more vectors than this are moving
+        still_sec   : Seconds to skip frames at the start and after motion
+        clock       : Function returning a monotonic time in seconds
+        mask        : Boolean array over the motion vector grid. Default = None
+        noise       : NoiseModel. Default = None
+        blobs       : BlobFinder. Default = None
+    """
+
+    def __init__(
+        self,
+        magnitude,
+        vectors=10,
+        still_sec=0,
+        clock=time.monotonic,
+        mask=None,
+        noise=None,
+        blobs=None,
+    ):
+        self.threshold = min((int(magnitude) + 1) ** 2, 0xFFFF)
+        self.vectors = vectors
+        self.still_sec = still_sec
+        self.clock = clock
+        self.mask = mask
+        self.noise = noise
+        self.blobs = blobs
+        self.stats = None
+        self.count = 0
+        self.frames = 0
+        self._quiet_until = None
+        self._shape = None
+
+    def _allocate(self, shape):
+        self._shape = shape
+        self._window = (slice(None), slice(None))
+        self._origin = (0, 0)
+        self._take = None
+        self._gathered = None
+        self._mask = None
+        if self.mask is not None:
+            if self.mask.shape != shape:
+                raise ValueError(
+                    "Mask {} does not fit motion vectors {}".format(
+                        self.mask.shape, shape
+                    )
+                )
+            # Only process the rows and columns with a macroblock in the mask
+            rows = np.flatnonzero(self.mask.any(axis=1))
+            cols = np.flatnonzero(self.mask.any(axis=0))
+            if len(rows):
+                self._window = (
+                    slice(int(rows[0]), int(rows[-1]) + 1),
+                    slice(int(cols[0]), int(cols[-1]) + 1),
+                )
+                self._origin = (int(rows[0]), int(cols[0]))
+            else:
+                self._window = (slice(0, 0), slice(0, 0))
+            mask = self.mask[self._window]
+            if self.blobs is None and mask.shape != (len(rows), len(cols)):
+                # Rows or columns without a macroblock in the mask within the
+                # window, eg. between two regions: gather only the ones in the
+                # mask. Blobs need the neighbours, they keep the window.
+                self._take = rows[:, np.newaxis] * shape[1] + cols
+                mask = self.mask[np.ix_(rows, cols)]
+            if not mask.all():
+                self._mask = np.ascontiguousarray(mask)
+            shape = mask.shape
+        self._x = np.empty(shape, dtype=np.int16)
+        self._y = np.empty(shape, dtype=np.int16)
+        self._sq = np.empty(shape, dtype=np.uint16)
+        self._moving = np.empty(shape, dtype=np.bool_)
+
+    def score(self, a):
+        """ Returns the number of vectors with a magnitude above the threshold.
+
+        Args:
+            a       : Motion vector array with "x" and "y" fields
+        """
+        if a.shape != self._shape:
+            self._allocate(a.shape)
+        x = self._x
+        y = self._y
+        # Contiguous int16 copies: squares of int8 fit (max 16384), their sum
+        # fits an uint16 (max 32768).
+        if self._take is None:
+            a = a[self._window]
+        else:
+            if self._gathered is None or self._gathered.dtype != a.dtype:
+                self._gathered = np.empty(self._take.shape, dtype=a.dtype)
+            a = np.take(a.reshape(-1), self._take, out=self._gathered, mode="clip")
+        np.copyto(x, a["x"])
+        np.copyto(y, a["y"])
+        np.multiply(x, x, out=x)
+        np.multiply(y, y, out=y)
+        np.add(x, y, out=self._sq, casting="unsafe")
+        np.greater_equal(self._sq, self.threshold, out=self._moving)
+        if self._mask is not None:
+            np.logical_and(self._moving, self._mask, out=self._moving)
+        if self.noise is not None:
+            self.noise.classify(self._sq, self._moving)
+        self.frames += 1
+        self.count = int(np.count_nonzero(self._moving))
+        return self.count
+
+    def detect(self, a, now=None):
+        """ Returns True when motion is detected in the frame.
+
+        Args:
+            a       : Motion vector array with "x" and "y" fields
+            now     : Monotonic time of the frame. Default = clock()
+        """
+        if now is None:
+            now = self.clock()
+        if self._quiet_until is None:
+            # The first frame starts the quiet period
+            self._quiet_until = now + self.still_sec
+        if now < self._quiet_until:
+            if self.noise is not None:
+                # Keep learning the noise
+                self.score(a)
+            return False
+        self.score(a)
+        if self.blobs is None:
+            detected = self.count > self.vectors
+        elif self.count >= self.blobs.min_size:
+            self.stats = self.blobs.find(self._moving, self._origin)
+            detected = self.stats.area >= self.blobs.min_size
+        else:
+            # Too few moving macroblocks for a large blob
+            detected = False
+        if detected:
+            self._quiet_until = now + self.still_sec
+        return detected
+
+
+# ********************************************************************************
+
+
+class FrameDifference:
+    """ Detects motion in grayscale frames, eg. the luma of the analysis stream,
+    without the H.264 encoder. Each frame is compared with a running average of
+    the previous frames (the background). Pixels which differ more than the
+    threshold are moving. All work is done in place on preallocated float32
+    buffers, O(pixels) per frame. After motion is detected, frames are skipped
+    for still_sec seconds, while the background keeps learning.
+
+    Args:
+        threshold   : A pixel is moving when it differs more than this (0..255)
+        pixels      : Motion is detected when more pixels than this are moving
+        alpha       : Learning rate of the background, 0..1
+        still_sec   : Seconds to skip frames at the start and after motion
+        clock       : Function returning a monotonic time in seconds
+        step        : Use every step-th pixel in both directions. Default = 1
+        mask        : Boolean array over the frame after step (see pixel_mask).
+                      Default = None
+    """
+
+    def __init__(
+        self,
+        threshold=25,
+        pixels=100,
+        alpha=0.05,
+        still_sec=0,
+        clock=time.monotonic,
+        step=1,
+        mask=None,
+    ):
+        self.threshold = threshold
+        self.pixels = pixels
+        self.alpha = alpha
+        self.still_sec = still_sec
+        self.clock = clock
+        self.step = step
+        self.mask = mask
+        self.count = 0
+        self.frames = 0
+        self._quiet_until = None
+        self._shape = None
+
+    def _allocate(self, shape):
+        if self.mask is not None and self.mask.shape != shape:
+            raise ValueError(
+                "Mask {} does not fit frames {}".format(self.mask.shape, shape)
+            )
+        self._shape = shape
+        self.background = np.empty(shape, dtype=np.float32)
+        self._frame = np.empty(shape, dtype=np.float32)
+        self._diff = np.empty(shape, dtype=np.float32)
+        self._moving = np.empty(shape, dtype=np.bool_)
+
+    def score(self, y):
+        """ Returns the number of pixels which differ from the background, and
+        updates the background.
+
+        Args:
+            y       : Grayscale frame, uint8
+        """
+        if self.step > 1:
+            y = y[:: self.step, :: self.step]
+        self.frames += 1
+        if y.shape != self._shape:
+            # The first frame is the background
+            self._allocate(y.shape)
+            np.copyto(self.background, y, casting="unsafe")
+            self.count = 0
+            return 0
+        frame = self._frame
+        diff = self._diff
+        np.copyto(frame, y, casting="unsafe")
+        np.subtract(frame, self.background, out=diff)
+        # background += alpha * (frame - background)
+        np.multiply(diff, self.alpha, out=frame)
+        np.add(self.background, frame, out=self.background)
+        np.abs(diff, out=diff)
+        np.greater(diff, self.threshold, out=self._moving)
+        if self.mask is not None:
+            np.logical_and(self._moving, self.mask, out=self._moving)
+        self.count = int(np.count_nonzero(self._moving))
+        return self.count
+
+    def detect(self, y, now=None):
+        """ Returns True when motion is detected in the frame.
+
+        Args:
+            y       : Grayscale frame, uint8
+            now     : Monotonic time of the frame. Default = clock()
+        """
+        if now is None:
+            now = self.clock()
+        if self._quiet_until is None:
+            # The first frame starts the quiet period
+            self._quiet_until = now + self.still_sec
+        self.score(y)
+        if now < self._quiet_until:
+            return False
+        detected = self.count > self.pixels
+        if detected:
+            self._quiet_until = now + self.still_sec
+        return detected
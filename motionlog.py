@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Recording of the raw motion vectors, to tune the motion detection offline.
+
+    File format (little endian):
+        Header, 32 bytes:
+            magic       4s  b"MVEC"
+            version     u2  1
+            rows        u2  Rows of the motion vector grid
+            cols        u2  Columns of the motion vector grid
+            header      u2  Size of the header (32)
+            framerate   f8  Frames per second
+            width       u2  Resolution of the video
+            height      u2
+        Records, one per frame, back to back:
+            time        f8  time.time() of the frame
+            vectors     rows x cols motion.MOTION_DTYPE
+
+    Every record has the same size, so a recording is one NumPy memmap.
+
+    Usage: python3 motionlog.py FILE.mvec
+"""
+import argparse
+import logging
+import queue
+import struct
+import threading
+import time
+import numpy as np
+import motion
+
+MAGIC = b"MVEC"
+VERSION = 1
+HEADER = struct.Struct("<4sHHHHdHH8x")
+
+logger = logging.getLogger(__name__)
+
+
+# --------------------------------------------------------------------------------
+def record_dtype(shape):
+    """ Returns the dtype of one frame record for a motion vector grid """
+    return np.dtype([("time", "<f8"), ("vectors", motion.MOTION_DTYPE, shape)])
+
+
+# ********************************************************************************
+
+
+class VectorWriter:
+    """ Appends motion vector frames to a file. write() copies a frame into a
+    preallocated buffer, full buffers are written by a background thread. When
+    all buffers wait for the disk, frames are dropped instead of blocking.
+
+    Args:
+        path        : File to write
+        shape       : Shape (rows, cols) of the motion vector grid
+        framerate   : Frames per second, stored in the header
+        resolution  : (width, height) of the video, stored in the header
+        frames      : Frames per buffer
+        buffers     : Number of buffers
+    """
+
+    def __init__(
+        self, path, shape, framerate=0, resolution=(0, 0), frames=64, buffers=4
+    ):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = record_dtype(self.shape)
+        self._free = queue.Queue()
+        for i in range(buffers):
+            self._free.put(np.empty(frames, dtype=self.dtype))
+        self._full = queue.Queue()
+        self._buffer = self._free.get()
+        self._count = 0
+        # Statistics
+        self.frames = 0
+        self.dropped = 0
+        self.file = open(path, "wb")
+        rows, cols = self.shape
+        width, height = resolution
+        self.file.write(
+            HEADER.pack(
+                MAGIC, VERSION, rows, cols, HEADER.size, framerate, width, height
+            )
+        )
+        self._thread = threading.Thread(target=self._run, name="motionlog", daemon=True)
+        self._thread.start()
+
+    def write(self, a, when=None):
+        """ Adds a frame. Returns False when it was dropped.
+
+        Args:
+            a       : Motion vectors (rows, cols) of motion.MOTION_DTYPE
+            when    : time.time() of the frame. Default = now
+        """
+        if self._buffer is None:
+            try:
+                self._buffer = self._free.get_nowait()
+            except queue.Empty:
+                self.dropped += 1
+                return False
+        self._buffer["time"][self._count] = time.time() if when is None else when
+        self._buffer["vectors"][self._count] = a
+        self._count += 1
+        self.frames += 1
+        if self._count == len(self._buffer):
+            self._full.put((self._buffer, self._count))
+            self._buffer = None
+            self._count = 0
+        return True
+
+    def close(self):
+        """ Writes the buffered frames and closes the file """
+        if self._buffer is not None and self._count:
+            self._full.put((self._buffer, self._count))
+        self._buffer = None
+        self._full.put(None)
+        self._thread.join()
+        self.file.close()
+        logger.info(
+            "Motion vectors: {} frames written to {}, {} dropped".format(
+                self.frames, self.path, self.dropped
+            )
+        )
+
+    def _run(self):
+        while True:
+            item = self._full.get()
+            if item is None:
+                return
+            buffer, count = item
+            try:
+                self.file.write(buffer[:count].data)
+            except OSError:
+                logger.exception("Writing {} failed".format(self.path))
+            self._free.put(buffer)
+
+
+# ********************************************************************************
+
+
+class VectorReader:
+    """ A motion vector recording as zero-copy NumPy views on a memmap. A
+    partly written last frame is ignored.
+
+    Args:
+        path    : File to read
+
+    Attributes:
+        times       : time.time() per frame, shape (frames,)
+        vectors     : Motion vectors, shape (frames, rows, cols)
+        framerate   : Frames per second
+        resolution  : (width, height) of the video
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+            f.seek(0, 2)
+            size = f.tell()
+        if len(header) < HEADER.size:
+            raise ValueError("{}: no motion vector recording".format(path))
+        magic, version, rows, cols, offset, framerate, width, height = HEADER.unpack(
+            header
+        )
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{}: no motion vector recording".format(path))
+        self.shape = (rows, cols)
+        self.framerate = framerate
+        self.resolution = (width, height)
+        dtype = record_dtype(self.shape)
+        frames = (size - offset) // dtype.itemsize
+        if frames:
+            self.records = np.memmap(
+                path, dtype=dtype, mode="r", offset=offset, shape=(frames,)
+            )
+        else:
+            self.records = np.empty(0, dtype=dtype)
+        self.times = self.records["time"]
+        self.vectors = self.records["vectors"]
+
+    def __len__(self):
+        return len(self.records)
+
+
+# --------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Show a motion vector recording")
+    parser.add_argument("file")
+    args = parser.parse_args()
+
+    reader = VectorReader(args.file)
+    print("Grid       : {} x {}".format(*reader.shape))
+    print("Resolution : {} x {}".format(*reader.resolution))
+    print("Frames     : {} at {} fps".format(len(reader), reader.framerate))
+    if len(reader):
+        print(
+            "Time       : {:.1f} sec. from {}".format(
+                reader.times[-1] - reader.times[0],
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(reader.times[0])),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
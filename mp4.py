@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Streaming remux of a raw H.264 (Annex B) stream into MP4, without
+    transcoding.
+
+    The stream is written to the mdat box as it arrives, one NAL unit at a time,
+    so the memory use does not grow with the video except for the sample table
+    (8 bytes per frame). The SPS and PPS go into the avcC box, the moov box with
+    the sample table and the keyframe index is written on close().
+
+    Usage: python3 mp4.py INPUT.h264 [OUTPUT.mp4] [-r FRAMERATE]
+"""
+import argparse
+import array
+import io
+import logging
+import os
+import struct
+
+logger = logging.getLogger(__name__)
+
+# NAL unit types
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+
+TIMESCALE = 90000
+MATRIX = struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+# --------------------------------------------------------------------------------
+def box(kind, *payload):
+    """ Returns an MP4 box """
+    data = b"".join(payload)
+    return struct.pack(">I4s", 8 + len(data), kind) + data
+
+
+# --------------------------------------------------------------------------------
+def full_box(kind, version, flags, *payload):
+    """ Returns an MP4 box with version and flags """
+    return box(kind, struct.pack(">I", (version << 24) | flags), *payload)
+
+
+# ********************************************************************************
+
+
+class _Bits:
+    """ Reads the exp-Golomb coded fields of a NAL unit """
+
+    def __init__(self, nal):
+        # Remove the emulation prevention bytes (00 00 03)
+        self.data = nal.replace(b"\x00\x00\x03", b"\x00\x00")
+        self.pos = 0
+
+    def u(self, n):
+        value = 0
+        for i in range(n):
+            byte = self.data[self.pos >> 3]
+            value = (value << 1) | ((byte >> (7 - (self.pos & 7))) & 1)
+            self.pos += 1
+        return value
+
+    def ue(self):
+        zeros = 0
+        while self.u(1) == 0:
+            zeros += 1
+        return (1 << zeros) - 1 + self.u(zeros)
+
+    def se(self):
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+# --------------------------------------------------------------------------------
+def sps_resolution(sps):
+    """ Returns (width, height) in pixels from a SPS NAL unit (without start code)"""
+    bits = _Bits(sps)
+    bits.u(8)
+    profile = bits.u(8)
+    bits.u(16)
+    bits.ue()
+    chroma_format = 1
+    if profile in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma_format = bits.ue()
+        if chroma_format == 3:
+            bits.u(1)
+        bits.ue()
+        bits.ue()
+        bits.u(1)
+        if bits.u(1):
+            for i in range(8 if chroma_format != 3 else 12):
+                if bits.u(1):
+                    last = scale = 8
+                    for j in range(16 if i < 6 else 64):
+                        if scale:
+                            scale = (last + bits.se()) % 256
+                        last = scale or last
+    bits.ue()
+    poc_type = bits.ue()
+    if poc_type == 0:
+        bits.ue()
+    elif poc_type == 1:
+        bits.u(1)
+        bits.se()
+        bits.se()
+        for i in range(bits.ue()):
+            bits.se()
+    bits.ue()
+    bits.u(1)
+    width = (bits.ue() + 1) * 16
+    height_units = bits.ue() + 1
+    frame_mbs_only = bits.u(1)
+    height = height_units * 16 * (2 - frame_mbs_only)
+    if not frame_mbs_only:
+        bits.u(1)
+    bits.u(1)
+    if bits.u(1):
+        left, right, top, bottom = bits.ue(), bits.ue(), bits.ue(), bits.ue()
+        crop_x = 2 if chroma_format in (1, 2) else 1
+        crop_y = (2 if chroma_format == 1 else 1) * (2 - frame_mbs_only)
+        width -= (left + right) * crop_x
+        height -= (top + bottom) * crop_y
+    return width, height
+
+
+# ********************************************************************************
+
+
+class Mp4Writer(io.RawIOBase):
+    """ Writes a raw H.264 stream, in chunks of any size, into an MP4 file.
+
+    Args:
+        output      : Filename or binary file of the MP4
+        framerate   : Frames per second
+        resolution  : (width, height), used when the SPS cannot be read
+    """
+
+    def __init__(self, output, framerate=30, resolution=(1920, 1080)):
+        super().__init__()
+        if isinstance(output, str):
+            output = io.open(output, "wb")
+            self._own = True
+        else:
+            self._own = False
+        self.output = output
+        self.framerate = framerate
+        self.resolution = resolution
+        self.sps = None
+        self.pps = None
+        self._buffer = bytearray()
+        self._sizes = array.array("I")
+        self._offsets = array.array("Q")
+        self._keyframes = array.array("I")
+        # The access unit (frame) which is being written
+        self._offset = None
+        self._size = 0
+        self._slice = False
+        self._key = False
+        self.output.write(
+            box(b"ftyp", b"isom", struct.pack(">I", 0x200), b"isomiso2avc1mp41")
+        )
+        self._mdat = self.output.tell()
+        # 64 bit mdat size, filled in by close()
+        self.output.write(struct.pack(">I4sQ", 1, b"mdat", 0))
+
+    @property
+    def frames(self):
+        """ Number of frames written """
+        return len(self._sizes)
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.output.tell()
+
+    def write(self, b):
+        """ Adds raw H.264 bytes. Complete NAL units are written immediately,
+        the last one is kept until its end is known.
+        """
+        buf = self._buffer
+        start = len(buf) - 3 if len(buf) > 3 else 0
+        buf += b
+        begin = 0
+        while True:
+            i = buf.find(b"\x00\x00\x01", max(start, begin + 3))
+            if i < 0:
+                break
+            if begin < i:
+                self._nal(buf, begin, i)
+            begin = i
+        del buf[:begin]
+        return len(b)
+
+    def _nal(self, buf, begin, end):
+        # Skip the start code, and the zero byte of a 4 byte start code
+        while buf[begin] == 0:
+            begin += 1
+        begin += 1
+        while end > begin and buf[end - 1] == 0:
+            end -= 1
+        if end <= begin:
+            return
+        kind = buf[begin] & 0x1F
+        if kind in (NAL_SPS, NAL_PPS, NAL_AUD, NAL_SEI) and self._slice:
+            self._end_frame()
+        # The first parameter sets go into the avcC box
+        if kind == NAL_SPS:
+            if self.sps is None and end - begin >= 4:
+                self.sps = bytes(buf[begin:end])
+            return
+        if kind == NAL_PPS:
+            if self.pps is None:
+                self.pps = bytes(buf[begin:end])
+            return
+        if kind == NAL_AUD:
+            return
+        if kind in (NAL_SLICE, NAL_IDR):
+            # first_mb_in_slice = 0 (a 1 bit) starts a new frame
+            if self._slice and end - begin > 1 and buf[begin + 1] & 0x80:
+                self._end_frame()
+            self._slice = True
+            self._key = self._key or kind == NAL_IDR
+        if self.sps is None:
+            # Not decodable before the first SPS
+            return
+        if self._offset is None:
+            self._offset = self.output.tell()
+        self.output.write(struct.pack(">I", end - begin))
+        self.output.write(buf[begin:end])
+        self._size += 4 + end - begin
+
+    def _end_frame(self):
+        if self._offset is not None and self._slice:
+            self._sizes.append(self._size)
+            self._offsets.append(self._offset)
+            if self._key:
+                self._keyframes.append(len(self._sizes))
+        self._offset = None
+        self._size = 0
+        self._slice = False
+        self._key = False
+
+    def close(self):
+        """ Writes the last frame and the moov box """
+        if self.closed:
+            return
+        if self._buffer:
+            self._buffer += b"\x00\x00\x01"
+            self.write(b"")
+        self._end_frame()
+        end = self.output.tell()
+        self.output.seek(self._mdat + 8)
+        self.output.write(struct.pack(">Q", end - self._mdat))
+        self.output.seek(end)
+        self.output.write(self._moov())
+        self.output.flush()
+        if self._own:
+            self.output.close()
+        logger.debug(
+            "MP4: {} frames, {} keyframes".format(
+                len(self._sizes), len(self._keyframes)
+            )
+        )
+        super().close()
+
+    def _moov(self):
+        width, height = self.resolution
+        if self.sps is not None:
+            try:
+                width, height = sps_resolution(self.sps)
+            except IndexError:
+                logger.warning("Cannot read the resolution from the SPS")
+        count = len(self._sizes)
+        delta = int(round(TIMESCALE / float(self.framerate)))
+        duration = count * delta
+        ms = duration * 1000 // TIMESCALE
+        mvhd = full_box(
+            b"mvhd",
+            0,
+            0,
+            struct.pack(">IIII", 0, 0, 1000, ms),
+            struct.pack(">IH10x", 0x10000, 0x100),
+            MATRIX,
+            bytes(24),
+            struct.pack(">I", 2),
+        )
+        tkhd = full_box(
+            b"tkhd",
+            0,
+            3,
+            struct.pack(">IIIII8xhhH2x", 0, 0, 1, 0, ms, 0, 0, 0),
+            MATRIX,
+            struct.pack(">II", width << 16, height << 16),
+        )
+        mdhd = full_box(
+            b"mdhd", 0, 0, struct.pack(">IIIIHH", 0, 0, TIMESCALE, duration, 0x55C4, 0)
+        )
+        hdlr = full_box(
+            b"hdlr", 0, 0, struct.pack(">I4s12x", 0, b"vide"), b"VideoHandler\x00"
+        )
+        vmhd = full_box(b"vmhd", 0, 1, bytes(8))
+        dinf = box(
+            b"dinf",
+            full_box(b"dref", 0, 0, struct.pack(">I", 1), full_box(b"url ", 0, 1)),
+        )
+        stbl = box(
+            b"stbl",
+            full_box(b"stsd", 0, 0, struct.pack(">I", 1), self._avc1(width, height)),
+            full_box(b"stts", 0, 0, struct.pack(">III", 1, count, delta)),
+            full_box(
+                b"stss",
+                0,
+                0,
+                struct.pack(">I", len(self._keyframes)),
+                _big_endian(self._keyframes),
+            ),
+            full_box(b"stsc", 0, 0, struct.pack(">IIII", 1, 1, 1, 1)),
+            full_box(
+                b"stsz", 0, 0, struct.pack(">II", 0, count), _big_endian(self._sizes)
+            ),
+            self._chunk_offsets(),
+        )
+        minf = box(b"minf", vmhd, dinf, stbl)
+        mdia = box(b"mdia", mdhd, hdlr, minf)
+        trak = box(b"trak", tkhd, mdia)
+        return box(b"moov", mvhd, trak)
+
+    def _avc1(self, width, height):
+        sps = self.sps or b"\x67\x64\x00\x28"
+        pps = [self.pps] if self.pps else []
+        avcc = bytes([1, sps[1], sps[2], sps[3], 0xFF, 0xE1])
+        avcc += struct.pack(">H", len(sps)) + sps
+        avcc += bytes([len(pps)])
+        for p in pps:
+            avcc += struct.pack(">H", len(p)) + p
+        if sps[1] in (100, 110, 122, 144):
+            # 4:2:0, 8 bit, no SPS extensions
+            avcc += bytes([0xFD, 0xF8, 0xF8, 0])
+        return box(
+            b"avc1",
+            bytes(6),
+            struct.pack(
+                ">HHH12xHHIIIH", 1, 0, 0, width, height, 0x480000, 0x480000, 0, 1
+            ),
+            bytes(32),
+            struct.pack(">Hh", 0x18, -1),
+            box(b"avcC", avcc),
+        )
+
+    def _chunk_offsets(self):
+        if not self._offsets or self._offsets[-1] < 1 << 32:
+            offsets = array.array("I", self._offsets)
+            return full_box(
+                b"stco", 0, 0, struct.pack(">I", len(offsets)), _big_endian(offsets)
+            )
+        return full_box(
+            b"co64",
+            0,
+            0,
+            struct.pack(">I", len(self._offsets)),
+            _big_endian(self._offsets),
+        )
+
+
+# --------------------------------------------------------------------------------
+def _big_endian(values):
+    """ Returns the bytes of an array.array in network byte order """
+    if struct.pack("=H", 1) == b"\x01\x00":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+# --------------------------------------------------------------------------------
+def remux(source, output, framerate=30, chunk=65536):
+    """ Remuxes a raw H.264 file into an MP4 file, chunk by chunk. Returns the
+    number of frames.
+
+    Args:
+        source      : Filename of the raw H.264 stream
+        output      : Filename of the MP4
+        framerate   : Frames per second
+        chunk       : Bytes read at a time
+    """
+    mp4 = Mp4Writer(output, framerate)
+    with io.open(source, "rb") as f:
+        while True:
+            data = f.read(chunk)
+            if not data:
+                break
+            mp4.write(data)
+    mp4.close()
+    return mp4.frames
+
+
+# --------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Remux raw H.264 into MP4")
+    parser.add_argument("input")
+    parser.add_argument("output", nargs="?")
+    parser.add_argument("-r", "--framerate", type=float, default=30)
+    args = parser.parse_args()
+    output = args.output or os.path.splitext(args.input)[0] + ".mp4"
+    frames = remux(args.input, output, args.framerate)
+    print("{}: {} frames".format(output, frames))
+
+
+if __name__ == "__main__":
+    main()
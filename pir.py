@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Edge triggered PIR sensor.
+
+    The GPIO pin raises an interrupt on every change, so a trigger is handled as
+    soon as the hardware reports it and the waiting thread sleeps in between.
+    SimulatedPir is a software stand-in for machines without GPIO.
+"""
+import logging
+import threading
+import time
+import backend
+
+try:
+    import gpiozero
+except ImportError:
+    gpiozero = None
+
+logger = logging.getLogger(__name__)
+
+
+# --------------------------------------------------------------------------------
+def open_pir(name, pin, debounce=0.2, event=None, **kwargs):
+    """ Returns a PIR sensor for the camera backend
+
+    Args:
+        name        : backend.PICAMERA (GPIO) or backend.SIMULATED
+        pin         : Pin number (board numbering)
+        debounce    : Ignore changes within this number of seconds
+        event       : threading.Event set on a trigger. Default = None (new)
+        kwargs      : Passed to SimulatedPir
+    """
+    logger.info("open_pir {} pin {}".format(name, pin))
+    if name == backend.SIMULATED:
+        return SimulatedPir(pin, debounce, event, **kwargs)
+    return GpioPir(pin, debounce, event)
+
+
+# ********************************************************************************
+
+
+class PirSensor:
+    """ State of a PIR sensor, updated by edges.
+
+    Args:
+        pin         : Pin number (board numbering)
+        debounce    : Ignore changes within this number of seconds
+        event       : threading.Event set on a trigger. Default = None (new)
+    """
+
+    def __init__(self, pin, debounce=0.2, event=None):
+        self.pin = pin
+        self.debounce = debounce
+        self.active = False
+        self.triggered = event if event is not None else threading.Event()
+        self._last_edge = None
+        self._edge_time = None
+        # Statistics
+        self.triggers = 0
+        self.ignored = 0
+        self.latency_count = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def edge(self, state):
+        """ Handles a change of the pin, called from the GPIO thread """
+        now = time.perf_counter()
+        if state == self.active:
+            return
+        if (
+            self._last_edge is not None
+            and (now - self._last_edge) * backend.speed < self.debounce
+        ):
+            self.ignored += 1
+            return
+        self._last_edge = now
+        self.active = state
+        logger.debug("GPIO pin {} is {}".format(self.pin, "HIGH" if state else "LOW"))
+        if state:
+            self.triggers += 1
+            self._edge_time = now
+            self.triggered.set()
+
+    def wait(self, timeout):
+        """ Waits for a trigger, returns True when triggered
+
+        Args:
+            timeout : Maximum seconds to wait
+        """
+        if backend.wait(self.triggered, timeout):
+            self.triggered.clear()
+            if self._edge_time is not None:
+                latency = time.perf_counter() - self._edge_time
+                self._edge_time = None
+                self.latency_count += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+            return True
+        return False
+
+    def wait_active(self, timeout):
+        """ Waits for a trigger, returns True when triggered or still active
+
+        Args:
+            timeout : Maximum seconds to wait
+        """
+        return self.wait(timeout) or self.active
+
+    def close(self):
+        if self.latency_count:
+            logger.info(
+                "PIR: {} triggers, {} ignored, latency avg. {:.2f} ms, max. {:.2f} ms".format(
+                    self.triggers,
+                    self.ignored,
+                    self.latency_total / self.latency_count * 1000,
+                    self.latency_max * 1000,
+                )
+            )
+
+
+# ********************************************************************************
+
+
+class GpioPir(PirSensor):
+    """ PIR connected to a GPIO pin of the RPi. gpiozero calls back on both edges
+    from the interrupt of the pin.
+    """
+
+    def __init__(self, pin, debounce=0.2, event=None):
+        if gpiozero is None:
+            raise RuntimeError("gpiozero is not installed")
+        super().__init__(pin, debounce, event)
+        self._device = gpiozero.DigitalInputDevice(
+            "BOARD{}".format(pin), pull_up=False, bounce_time=debounce or None
+        )
+        self.active = self._device.is_active
+        self._device.when_activated = lambda: self.edge(True)
+        self._device.when_deactivated = lambda: self.edge(False)
+
+    def close(self):
+        super().close()
+        self._device.close()
+
+
+# ********************************************************************************
+
+
+class SimulatedPir(PirSensor):
+    """ Software PIR. Edges come from set(), or every interval seconds the PIR is
+    active for duration seconds (simulated time).
+
+    Args:
+        pin         : Pin number, only used for logging
+        debounce    : Ignore changes within this number of seconds
+        event       : threading.Event set on a trigger. Default = None (new)
+        interval    : Seconds between triggers. Default = None (only set())
+        duration    : Seconds a trigger is active
+    """
+
+    def __init__(self, pin, debounce=0.2, event=None, interval=None, duration=2):
+        super().__init__(pin, debounce, event)
+        self._stop = threading.Event()
+        self._thread = None
+        if interval:
+            self._thread = threading.Thread(
+                target=self._run, args=(interval, duration), daemon=True
+            )
+            self._thread.start()
+
+    def set(self, state):
+        """ Changes the simulated pin, like an interrupt would """
+        self.edge(state)
+
+    def _run(self, interval, duration):
+        while not backend.wait(self._stop, interval - duration):
+            self.set(True)
+            if backend.wait(self._stop, duration):
+                break
+            self.set(False)
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        super().close()
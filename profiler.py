@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Sampling profiler for a running process.
+
+    A background thread samples the stacks of all other threads (the main loop,
+    the encoder callback running detect_motion.analyse, the writers) at a fixed
+    interval. On stop the samples are written in the collapsed stack format of
+    flamegraph.pl and speedscope:
+
+        thread;module:function;module:function count
+
+    Nothing runs while the profiler is off. kill -USR1 PID starts and stops it.
+"""
+import collections
+import datetime
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_profiler = None
+
+
+# ********************************************************************************
+
+
+class SamplingProfiler:
+    """ Samples the stacks of all threads until stop()
+
+    Args:
+        path        : File for the collapsed stacks
+        interval    : Seconds between samples
+    """
+
+    def __init__(self, path, interval=0.005):
+        self.path = path
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._names = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        logger.info("Profiling to {}".format(self.path))
+        self._thread.start()
+
+    def stop(self, wait=True):
+        """ Stops sampling and writes the collapsed stacks
+
+        Args:
+            wait    : Wait until the file is written
+        """
+        self._stop.set()
+        if wait:
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        deadline = time.monotonic()
+        while not self._stop.is_set():
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                self.stacks[self._collapse(names.get(ident, str(ident)), frame)] += 1
+            self.samples += 1
+            deadline += self.interval
+            self._stop.wait(max(0, deadline - time.monotonic()))
+        self._write()
+
+    def _collapse(self, thread, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            name = self._names.get(code)
+            if name is None:
+                module = os.path.splitext(os.path.basename(code.co_filename))[0]
+                name = "{}:{}".format(module, code.co_name).replace(";", ":")
+                self._names[code] = name
+            names.append(name)
+            frame = frame.f_back
+        names.append(thread.replace(";", ":").replace(" ", "_"))
+        return ";".join(reversed(names))
+
+    def _write(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+        logger.info(
+            "Profile: {} samples of {} stacks written to {}".format(
+                self.samples, len(self.stacks), self.path
+            )
+        )
+
+
+# --------------------------------------------------------------------------------
+def start(directory, interval=0.005):
+    """ Starts profiling into a new file in directory, unless it is running
+
+    Args:
+        directory   : Directory for the profiles
+        interval    : Seconds between samples
+    """
+    global _profiler
+
+    if _profiler is None:
+        name = datetime.datetime.now().strftime("profile-%Y%m%d-%H%M%S.collapsed")
+        _profiler = SamplingProfiler(os.path.join(directory, name), interval)
+        _profiler.start()
+
+
+# --------------------------------------------------------------------------------
+def stop():
+    """ Stops profiling and writes the profile, if it is running """
+    global _profiler
+
+    if _profiler is not None:
+        profiler, _profiler = _profiler, None
+        profiler.stop()
+
+
+# --------------------------------------------------------------------------------
+def toggle(directory, interval=0.005):
+    """ Starts profiling, or stops it when it is running """
+    global _profiler
+
+    if _profiler is None:
+        start(directory, interval)
+    else:
+        # The profiler thread writes the file, a signal handler must not wait
+        profiler, _profiler = _profiler, None
+        profiler.stop(wait=False)
+
+
+# --------------------------------------------------------------------------------
+def install(directory, interval=0.005, signum=signal.SIGUSR1):
+    """ Toggles profiling on the signal (kill -USR1 PID)
+
+    Args:
+        directory   : Directory for the profiles
+        interval    : Seconds between samples
+        signum      : Signal. Default = SIGUSR1
+    """
+    signal.signal(signum, lambda signum, frame: toggle(directory, interval))
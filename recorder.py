@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Event recording with pre-roll.
+
+    The encoder records continuously into a circular buffer in memory. When an
+    event starts, the recording is split (no encoder restart) into an event file,
+    which starts with the buffered pre-roll followed by the live video. Events
+    are raw H.264, or remuxed into MP4 while they are written (see mp4.py).
+"""
+import io
+import logging
+import os
+import threading
+import time
+import backend
+import metrics
+import mp4
+
+H264 = "h264"
+MP4 = "mp4"
+
+logger = logging.getLogger(__name__)
+
+splitSeconds = metrics.histogram(
+    "camera_split_seconds", "Time to split the recording to or from an event file"
+)
+prerollSeconds = metrics.histogram(
+    "camera_preroll_seconds", "Time to write the pre-roll of an event file"
+)
+recordingSeconds = metrics.histogram(
+    "camera_recording_start_stop_seconds", "Time to start or stop the recording"
+)
+
+
+# --------------------------------------------------------------------------------
+def write_video(stream, output, seconds=None):
+    """ Write the content of the circular buffer, starting at a SPS header, to
+    output and wipe the buffer. The encoder must not write to the stream.
+
+    Args:
+        stream  : Circular buffer
+        output  : File like object
+        seconds : Only write the last seconds. Default = None (all)
+    """
+    logger.info("write_video")
+    stream.copy_to(output, seconds=seconds, first_frame=backend.SPS_HEADER)
+    # Wipe the circular stream once we're done
+    stream.clear()
+
+
+# ********************************************************************************
+
+
+class EventOutput:
+    """ Recording output of one event. The encoder writes the live video from
+    the split on, while the caller of the split copies the pre-roll from the
+    circular buffer (write_preroll). Until the pre-roll is written, the live
+    video is kept in memory, so the encoder callback never waits for the copy.
+
+    Args:
+        path    : Filename of the event
+        stream  : Circular buffer with the pre-roll. Default = None (no pre-roll)
+        seconds : Seconds of pre-roll
+        on_close: Function(path, size) called when the file is closed
+        camera  : With container MP4: the camera, for the frame rate and size
+        container : H264 (raw) or MP4. Default = H264
+    """
+
+    def __init__(
+        self,
+        path,
+        stream=None,
+        seconds=None,
+        on_close=None,
+        camera=None,
+        container=H264,
+    ):
+        self.path = path
+        self.stream = stream
+        self.seconds = seconds
+        self.on_close = on_close
+        self.camera = camera
+        self.container = container
+        self.file = None
+        self.size = 0
+        self._lock = threading.Lock()
+        # Live video which arrived before the pre-roll was written
+        self._pending = [] if stream is not None else None
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        """ Called by the encoder """
+        with self._lock:
+            self.size += len(b)
+            if self._pending is not None:
+                self._pending.append(bytes(b))
+                return len(b)
+            if self.file is None:
+                self._open()
+            return self.file.write(b)
+
+    def write_preroll(self):
+        """ Writes the pre-roll and the live video kept meanwhile. Called after
+        the split, when the encoder no longer writes to the circular buffer.
+        """
+        start = time.perf_counter()
+        self._open()
+        # The copy starts at the first SPS header within the seconds, one intra
+        # period (a second) more keeps at least the full pre-roll
+        write_video(self.stream, self.file, self.seconds + 1)
+        while True:
+            with self._lock:
+                pending, self._pending = self._pending, []
+                if len(pending) <= 1:
+                    # The last frames are written under the lock, the next
+                    # write of the encoder goes to the file
+                    for data in pending:
+                        self.file.write(data)
+                    self._pending = None
+                    self.size = self.file.tell()
+                    break
+            for data in pending:
+                self.file.write(data)
+        prerollSeconds.observe(time.perf_counter() - start)
+
+    def _open(self):
+        if self.container == MP4:
+            self.file = mp4.Mp4Writer(
+                self.path, self.camera.framerate, self.camera.resolution
+            )
+        else:
+            self.file = io.open(self.path, "wb")
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            if self.on_close is not None:
+                self.on_close(self.path, os.path.getsize(self.path))
+
+
+# ********************************************************************************
+
+
+class EventRecorder:
+    """ Records H.264 into a circular buffer and splits events off into files.
+
+    Args:
+        camera          : Camera to record with
+        preroll         : Seconds of video before the event
+        motion_output   : Output for the motion vectors. Default = None
+        on_close        : Function(path, size) called when an event file is
+                          closed. Default = None
+        container       : H264 (raw) or MP4. Default = H264
+    """
+
+    def __init__(
+        self, camera, preroll, motion_output=None, on_close=None, container=H264
+    ):
+        if container not in (H264, MP4):
+            raise ValueError("Invalid container: {}".format(container))
+        self.camera = camera
+        self.preroll = preroll
+        self.motion_output = motion_output
+        self.on_close = on_close
+        self.container = container
+        # Keep an extra second, the buffer must reach back to a SPS header
+        self.stream = backend.circular_io(camera, preroll + 1)
+        self.event = None
+
+    def start(self):
+        logger.info("start recording with {} sec. pre-roll".format(self.preroll))
+        # A keyframe with SPS header every second, the pre-roll starts at one
+        start = time.perf_counter()
+        self.camera.start_recording(
+            self.stream,
+            format="h264",
+            intra_period=int(self.camera.framerate),
+            motion_output=self.motion_output,
+        )
+        recordingSeconds.observe(time.perf_counter() - start)
+
+    def stop(self):
+        if self.event is not None:
+            self.end_event()
+        start = time.perf_counter()
+        self.camera.stop_recording()
+        recordingSeconds.observe(time.perf_counter() - start)
+
+    def start_event(self, path):
+        """ Starts recording the event, including the pre-roll, into path """
+        logger.debug("Event {}".format(path))
+        self.event = EventOutput(
+            path, self.stream, self.preroll, self.on_close, self.camera, self.container
+        )
+        self._split(self.event)
+        self.event.write_preroll()
+
+    def split_event(self, path):
+        """ Continues recording the event into a next segment, without a gap """
+        logger.debug("Segment {}".format(path))
+        previous = self.event
+        self.event = EventOutput(
+            path, on_close=self.on_close, camera=self.camera, container=self.container
+        )
+        self._split(self.event)
+        previous.close()
+
+    def end_event(self):
+        """ Continues recording into the circular buffer """
+        self._split(self.stream)
+        self.event.close()
+        self.event = None
+
+    def _split(self, output):
+        start = time.perf_counter()
+        self.camera.split_recording(output)
+        splitSeconds.observe(time.perf_counter() - start)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Replay harness: runs a modus of camera.py on the simulated camera backend
+    and reports its throughput and latency. Used to catch performance
+    regressions on a normal Linux machine before deploying to a RPi.
+
+    Usage: python3 replay.py MODUS [MODUS ...] [-s SOURCE] [-x SPEED] [-d SECONDS]
+                             [-o DIR] [-r MODUS]
+
+    More than one modus run together, as tasks of one event loop.
+
+    With -r the second modus is started on the open camera (warm restart)
+    after the first one, for another SECONDS.
+"""
+import argparse
+import os
+import signal
+import tempfile
+import time
+import config
+import modus
+
+
+# --------------------------------------------------------------------------------
+def stop(signum, frame):
+    raise KeyboardInterrupt()
+
+
+# --------------------------------------------------------------------------------
+def report(name, camera, actions, wall, cpu, startup, run=None):
+    print("Modus      : {}".format(name))
+    if startup is not None:
+        print("Startup    : {:.1f} ms until ready".format(startup * 1e3))
+    print(
+        "Time       : {:.1f} s wall, {:.1f} s simulated, {:.1f} s CPU ({:.0f}%)".format(
+            wall, wall * camera.speed, cpu, 100 * cpu / wall if wall else 0
+        )
+    )
+    print("Actions    : {}".format(actions))
+    print(
+        "Frames     : {} ({:.1f} fps), {} dropped".format(
+            camera.frames, camera.frames / wall if wall else 0, camera.dropped
+        )
+    )
+    if camera.analyse_count:
+        print(
+            "analyse    : {} frames, {:.1f} us mean, {:.1f} us max".format(
+                camera.analyse_count,
+                camera.analyse_time / camera.analyse_count * 1e6,
+                camera.analyse_max * 1e6,
+            )
+        )
+    if camera.captures:
+        print(
+            "capture    : {} images, {:.2f} ms mean".format(
+                camera.captures, camera.capture_time / camera.captures * 1e3
+            )
+        )
+    if run is not None and run.wakeups:
+        print(
+            "run loop   : {} wakeups, {:.2f} ms mean, {:.2f} ms max late".format(
+                run.wakeups,
+                run.latency_total / run.wakeups * 1e3,
+                run.latency_max * 1e3,
+            )
+        )
+
+
+# --------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Replay a modus without a camera")
+    modi = [
+        modus.MOTIONIMAGE,
+        modus.MOTIONVIDEO,
+        modus.PIRIMAGE,
+        modus.PIRVIDEO,
+        modus.TESTIMAGE,
+        modus.TIMELAPSE,
+    ]
+    parser.add_argument("modus", nargs="+", choices=modi)
+    parser.add_argument("-s", "--source", help="Recording directory")
+    parser.add_argument("-x", "--speed", type=float, default=1, help="Replay speed")
+    parser.add_argument("-d", "--duration", type=float, default=10, help="Seconds")
+    parser.add_argument("-o", "--output", help="Output directory (default: temp)")
+    parser.add_argument("-r", "--restart", choices=modi, help="Warm restart modus")
+    args = parser.parse_args()
+
+    output = args.output or tempfile.mkdtemp(prefix="replay-")
+    config.appModus = args.modus[0] if len(args.modus) == 1 else args.modus
+    config.appBackend = "simulated"
+    config.simSource = args.source
+    config.simSpeed = args.speed
+    config.gbImageDir = os.path.join(output, "images")
+    config.gbVideoDir = os.path.join(output, "video")
+    config.gbQuotaIndex = os.path.join(output, ".quota")
+    config.gbCatalogue = os.path.join(output, "catalogue.db")
+    config.appProfileDir = os.path.join(output, "profiles")
+
+    import camera
+
+    signal.signal(signal.SIGALRM, stop)
+    runs = [
+        (" + ".join(args.modus), lambda: camera.main(keep_camera=bool(args.restart)))
+    ]
+    if args.restart:
+        runs.append((args.restart, lambda: camera.restart(args.restart)))
+    for name, run in runs:
+        actions = camera.actionCount
+        signal.setitimer(signal.ITIMER_REAL, args.duration)
+        start = time.monotonic()
+        cpu = time.process_time()
+        try:
+            run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        if camera.camera is None:
+            # The modus was not valid
+            break
+        report(
+            name,
+            camera.camera,
+            camera.actionCount - actions,
+            time.monotonic() - start,
+            time.process_time() - cpu,
+            camera.startupTime,
+            camera.runLoop,
+        )
+    print("Output     : {}".format(output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    One asyncio event loop which runs the modi as tasks.
+
+    The tasks wait for their deadlines and triggers on the loop. Blocking calls,
+    like the camera calls, run in a thread pool (RunLoop.call), so the capture of
+    one task does not hold up the others. The loop measures how late the tasks
+    wake up for their deadlines and triggers: the scheduling latency.
+
+    asyncio is imported when a RunLoop is created, a Trigger does not need it.
+"""
+import contextvars
+import functools
+import logging
+import threading
+import time
+import backend
+import metrics
+
+logger = logging.getLogger(__name__)
+
+latencySeconds = metrics.histogram(
+    "camera_loop_latency_seconds",
+    "How late the tasks of the run loop wake up for their deadlines and triggers",
+)
+
+
+# ********************************************************************************
+
+
+class Trigger(threading.Event):
+    """ threading.Event which a task of the run loop can also wait for, see
+    RunLoop.wait. set() may be called from any thread, eg. the encoder callback
+    or the GPIO interrupt.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.set_time = None
+        # (loop, asyncio.Event) of the waiting task
+        self._waiter = None
+
+    def set(self):
+        self.set_time = time.perf_counter()
+        super().set()
+        waiter = self._waiter
+        if waiter is not None:
+            loop, event = waiter
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The loop is closed
+                pass
+
+
+# ********************************************************************************
+
+
+class RunLoop:
+    """ Runs tasks on a new event loop until they are all done
+
+    Args:
+        workers : Threads for the blocking calls
+    """
+
+    def __init__(self, workers=4):
+        import asyncio
+        import concurrent.futures
+
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix="runloop"
+        )
+        self._tasks = []
+        # Statistics
+        self.wakeups = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def add(self, name, coro):
+        """ Adds a task, started by run()
+
+        Args:
+            name    : Name of the task
+            coro    : Coroutine of the task
+        """
+        self._tasks.append((name, coro))
+
+    def run(self):
+        """ Runs the tasks. When a task fails, or on KeyboardInterrupt or
+        SystemExit, the other tasks are cancelled and can clean up.
+        """
+        main = self.loop.create_task(self._main())
+        try:
+            self.loop.run_until_complete(main)
+        except BaseException:
+            main.cancel()
+            try:
+                self.loop.run_until_complete(main)
+            except BaseException:
+                pass
+            raise
+        finally:
+            self.executor.shutdown()
+            self.loop.close()
+            self.log_statistics()
+
+    async def _main(self):
+        import asyncio
+
+        tasks = [self.loop.create_task(coro, name=name) for name, coro in self._tasks]
+        try:
+            done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_EXCEPTION
+            )
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def call(self, func, *args, **kwargs):
+        """ Runs a blocking function in the thread pool, in the context of the
+        task. Returns its result.
+        """
+        import asyncio
+
+        context = contextvars.copy_context()
+        future = self.loop.run_in_executor(
+            self.executor, functools.partial(context.run, func, *args, **kwargs)
+        )
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # A thread cannot be interrupted, the call ends before the cleanup
+            await asyncio.wait([future])
+            raise
+
+    async def sleep_until(self, deadline):
+        """ Sleeps until deadline (backend.monotonic()) """
+        import asyncio
+
+        delay = deadline - backend.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay / backend.speed)
+            self._observe((backend.monotonic() - deadline) / backend.speed)
+
+    async def wait(self, trigger, timeout):
+        """ Waits for a Trigger, returns True when it is set
+
+        Args:
+            trigger : Trigger
+            timeout : Maximum seconds to wait
+        """
+        import asyncio
+
+        if trigger.is_set():
+            return True
+        waiter = trigger._waiter
+        if waiter is None or waiter[0] is not self.loop:
+            waiter = trigger._waiter = (self.loop, asyncio.Event())
+        event = waiter[1]
+        event.clear()
+        if trigger.is_set():
+            return True
+        try:
+            await asyncio.wait_for(event.wait(), timeout / backend.speed)
+        except asyncio.TimeoutError:
+            return trigger.is_set()
+        if trigger.set_time is not None:
+            self._observe(time.perf_counter() - trigger.set_time)
+        return True
+
+    def _observe(self, late):
+        late = max(0.0, late)
+        latencySeconds.observe(late)
+        self.wakeups += 1
+        self.latency_total += late
+        self.latency_max = max(self.latency_max, late)
+
+    def log_statistics(self):
+        if self.wakeups:
+            logger.info(
+                "Run loop: {} wakeups, {:.2f} ms avg., {:.2f} ms max. late".format(
+                    self.wakeups,
+                    self.latency_total / self.wakeups * 1000,
+                    self.latency_max * 1000,
+                )
+            )
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Drift free scheduling of periodic actions on a monotonic clock.
+"""
+import logging
+import backend
+
+SKIP = "skip"
+CATCHUP = "catchup"
+
+logger = logging.getLogger(__name__)
+
+
+# ********************************************************************************
+
+
+class DeadlineScheduler:
+    """ Waits for deadlines at start + n * interval. The time an action takes is
+    compensated, so the interval does not drift.
+
+    When an action overruns the next deadline, SKIP waits for the first deadline
+    still ahead, CATCHUP returns at once until the schedule is met again.
+
+    Args:
+        interval    : Seconds between the deadlines
+        overrun     : SKIP or CATCHUP
+        clock       : Function returning a monotonic time in seconds
+        sleep       : Function sleeping for a number of seconds
+    """
+
+    def __init__(
+        self, interval, overrun=SKIP, clock=backend.monotonic, sleep=backend.sleep
+    ):
+        if overrun not in (SKIP, CATCHUP):
+            raise ValueError("Invalid overrun: {}".format(overrun))
+        self.interval = interval
+        self.overrun = overrun
+        self.clock = clock
+        self.sleep = sleep
+        self.deadline = None
+        # Statistics
+        self.overruns = 0
+        self.skipped = 0
+        self.max_late = 0.0
+
+    def start(self):
+        """ The first deadline is now """
+        self.deadline = self.clock()
+
+    def wait(self):
+        """ Waits for the next deadline. Returns the number of skipped deadlines. """
+        skipped = self.advance()
+        self.sleep(max(0, self.deadline - self.clock()))
+        return skipped
+
+    def advance(self):
+        """ Moves to the next deadline without waiting, for callers which wait
+        themselves until self.deadline. Returns the number of skipped deadlines.
+        """
+        if self.deadline is None:
+            self.start()
+        self.deadline += self.interval
+        late = self.clock() - self.deadline
+        if late <= 0:
+            return 0
+        self.overruns += 1
+        self.max_late = max(self.max_late, late)
+        if self.overrun == CATCHUP:
+            logger.debug("Overrun by {:.3f} sec., catching up".format(late))
+            return 0
+        skipped = int(late // self.interval) + 1
+        self.skipped += skipped
+        self.deadline += skipped * self.interval
+        logger.debug("Overrun by {:.3f} sec., skipped {}".format(late, skipped))
+        return skipped
+
+    def log_statistics(self):
+        logger.info(
+            "Schedule: {} overruns, {} skipped, max. {:.3f} sec. late".format(
+                self.overruns, self.skipped, self.max_late
+            )
+        )
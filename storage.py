@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Output directories and sequence numbers.
+
+    Thousands of files in one directory make every directory operation slow,
+    especially on FAT32/exFAT USB sticks. ShardedDirs spreads the files over
+    subdirectories per date, hour or block of sequence numbers. SequenceCounter
+    continues the numbering after a restart without scanning the directory.
+    QuotaManager deletes the oldest captures before the storage is full.
+"""
+import collections
+import logging
+import os
+import threading
+import time
+
+NONE = ""
+DATE = "date"
+HOUR = "hour"
+SEQUENCE = "sequence"
+
+logger = logging.getLogger(__name__)
+
+
+# ********************************************************************************
+
+
+class ShardedDirs:
+    """ Subdirectories of root, created on first use. Known directories are
+    cached, so a capture does not check the file system.
+
+    Args:
+        root    : Directory to store the files
+        scheme  : NONE, DATE ("YYYY-MM-DD"), HOUR ("YYYY-MM-DD/HH") or SEQUENCE
+        size    : Number of sequence numbers per directory with SEQUENCE
+        width   : Width of the directory names with SEQUENCE
+    """
+
+    FORMATS = {DATE: "%Y-%m-%d", HOUR: "%Y-%m-%d/%H"}
+
+    def __init__(self, root, scheme=NONE, size=1000, width=7):
+        if scheme not in (NONE, DATE, HOUR, SEQUENCE):
+            raise ValueError("Invalid scheme: {}".format(scheme))
+        self.root = root
+        self.scheme = scheme
+        self.size = size
+        self.width = width
+        self._known = set()
+        # Statistics
+        self.created = 0
+
+    def path(self, sequence=None, when=None):
+        """ Returns the directory for a file, and creates it when needed
+
+        Args:
+            sequence    : Sequence number of the file, used with SEQUENCE
+            when        : time.struct_time of the file. Default = now
+        """
+        if self.scheme == NONE or (self.scheme == SEQUENCE and sequence is None):
+            return self.root
+        if self.scheme == SEQUENCE:
+            name = str(sequence // self.size * self.size).zfill(self.width)
+        else:
+            name = time.strftime(self.FORMATS[self.scheme], when or time.localtime())
+        path = os.path.join(self.root, name)
+        if path not in self._known:
+            if not os.path.isdir(path):
+                logger.debug("Creating folder {}".format(path))
+                os.makedirs(path, exist_ok=True)
+                self.created += 1
+            self._known.add(path)
+        return path
+
+
+# ********************************************************************************
+
+
+class SequenceCounter:
+    """ Sequence number which continues after a restart. Numbers are reserved
+    in blocks in a state file, so the file is written once per block. After a
+    crash at most one block of numbers is skipped, never a number reused.
+
+    Args:
+        path    : State file
+        block   : Numbers to reserve at a time
+        start   : First number when there is no state file
+    """
+
+    def __init__(self, path, block=100, start=1):
+        self.path = path
+        self.block = max(1, block)
+        self._next = self._load(start)
+        self._limit = self._next
+        # Statistics
+        self.writes = 0
+
+    def _load(self, start):
+        try:
+            with open(self.path) as f:
+                return max(start, int(f.read().strip()))
+        except (OSError, ValueError):
+            return start
+
+    def _save(self, value):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("{}\n".format(value))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.writes += 1
+
+    def next(self):
+        """ Returns the next sequence number """
+        if self._next >= self._limit:
+            self._limit = self._next + self.block
+            self._save(self._limit)
+        value = self._next
+        self._next += 1
+        return value
+
+    def close(self):
+        """ Returns the unused numbers of the reserved block """
+        if self._limit > self._next:
+            self._save(self._next)
+            self._limit = self._next
+
+
+# ********************************************************************************
+
+
+class QuotaManager:
+    """ Keeps the captures below max_bytes, and at least min_free bytes free on
+    the file system. The oldest captures are deleted first.
+
+    The captures are kept in order in memory and in an append-only index file,
+    so a check never walks the directories. Only when there is no index yet,
+    the existing files are read once. Added captures are handled in a
+    background thread, so deleting never stalls capturing.
+
+    Args:
+        index       : Index file
+        roots       : Directories with the captures
+        max_bytes   : Maximum bytes of all captures. 0 = no maximum
+        min_free    : Minimum free bytes on the file system. 0 = no minimum
+    """
+
+    def __init__(self, index, roots, max_bytes=0, min_free=0):
+        self.index = index
+        self.roots = roots
+        self.max_bytes = max_bytes
+        self.min_free = min_free
+        self._entries = collections.deque()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        # Evicted entries which are still in the index file
+        self._stale = 0
+        # Statistics
+        self.usage = 0
+        self.evicted = 0
+        self.evicted_bytes = 0
+        self.errors = 0
+        if os.path.exists(index):
+            self._load()
+        else:
+            self._scan()
+            self._compact()
+        self._file = open(index, "a")
+        logger.info(
+            "Quota: {} files, {} bytes in use".format(len(self._entries), self.usage)
+        )
+        self._thread = threading.Thread(target=self._run, name="quota", daemon=True)
+        self._thread.start()
+
+    @property
+    def files(self):
+        """ Number of captures in the index """
+        return len(self._entries)
+
+    def free(self):
+        """ Returns the free bytes on the file system of the captures """
+        root = next((r for r in self.roots if os.path.isdir(r)), ".")
+        st = os.statvfs(root)
+        return st.f_bavail * st.f_frsize
+
+    def add(self, path, size):
+        """ Adds a capture which has been written. Called from any thread.
+
+        Args:
+            path    : Filename of the capture
+            size    : Size in bytes
+        """
+        with self._lock:
+            self._pending.append((path, size))
+        self._wake.set()
+
+    def close(self):
+        """ Handles the added captures and stops the background thread """
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+        self._file.close()
+        logger.info(
+            "Quota: {} files, {} bytes in use, {} evicted ({} bytes), {} errors".format(
+                len(self._entries),
+                self.usage,
+                self.evicted,
+                self.evicted_bytes,
+                self.errors,
+            )
+        )
+
+    def _load(self):
+        with open(self.index) as f:
+            for line in f:
+                if line.startswith("+"):
+                    size, path = line[1:].rstrip("\n").split(" ", 1)
+                    self._entries.append((path, int(size)))
+                    self.usage += int(size)
+                elif line.startswith("-") and self._entries:
+                    self.usage -= self._entries.popleft()[1]
+                    self._stale += 1
+
+    def _scan(self):
+        """ Indexes the existing captures, oldest first """
+        found = []
+        for root in self.roots:
+            for dirpath, dirnames, filenames in os.walk(root):
+                for name in filenames:
+                    if name.startswith("."):
+                        continue
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    found.append((st.st_mtime, path, st.st_size))
+        for mtime, path, size in sorted(found):
+            self._entries.append((path, size))
+            self.usage += size
+
+    def _compact(self):
+        """ Rewrites the index without the evicted captures """
+        tmp = self.index + ".tmp"
+        with open(tmp, "w") as f:
+            for path, size in self._entries:
+                f.write("+{} {}\n".format(size, path))
+        os.replace(tmp, self.index)
+        self._stale = 0
+
+    def _over(self):
+        if self.max_bytes and self.usage > self.max_bytes:
+            return True
+        return bool(self.min_free) and self.free() < self.min_free
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            stopping = self._stopping
+            with self._lock:
+                pending, self._pending = self._pending, []
+            for path, size in pending:
+                self._entries.append((path, size))
+                self.usage += size
+                self._file.write("+{} {}\n".format(size, path))
+            try:
+                while self._entries and self._over():
+                    self._evict()
+            except OSError:
+                logger.exception("Checking the quota failed")
+                self.errors += 1
+            self._file.flush()
+            if self._stale > max(1000, len(self._entries)):
+                self._file.close()
+                self._compact()
+                self._file = open(self.index, "a")
+            if stopping:
+                return
+
+    def _evict(self):
+        path, size = self._entries.popleft()
+        self.usage -= size
+        self._file.write("-\n")
+        self._stale += 1
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logger.exception("Deleting {} failed".format(path))
+            self.errors += 1
+            return
+        self.evicted += 1
+        self.evicted_bytes += size
+        logger.debug("Quota: deleted {}".format(path))
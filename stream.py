@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Low resolution analysis stream.
+
+    The GPU resizes the video to a small raw YUV420 stream on its own splitter
+    port, next to the full resolution recording. Frames are copied into a few
+    preallocated buffers and handed to the subscribers in a dispatch thread, so
+    the encoder callback only copies a few hundred kB per frame. When the
+    subscribers are slower than the camera, the oldest waiting frame is dropped.
+
+    numpy is imported when a stream is created.
+"""
+import io
+import logging
+import threading
+import time
+import backend
+import metrics
+
+logger = logging.getLogger(__name__)
+
+dispatchSeconds = metrics.histogram(
+    "camera_stream_seconds", "Time the subscribers take per analysis stream frame"
+)
+droppedTotal = metrics.counter(
+    "camera_stream_dropped_total",
+    "Analysis stream frames dropped because the subscribers were busy",
+)
+
+
+# --------------------------------------------------------------------------------
+def padded(width, height):
+    """ Returns the size (width, height) of a raw frame in memory. The camera
+    pads the width to a multiple of 32 and the height to a multiple of 16.
+    """
+    return (width + 31) // 32 * 32, (height + 15) // 16 * 16
+
+
+# ********************************************************************************
+
+
+class Frame:
+    """ One buffer of the analysis stream. y, u and v are views on the buffer,
+    cropped to the resolution. They are only valid during the callback, a
+    subscriber copies what it keeps.
+
+    Attributes:
+        index   : Number of the frame in the stream
+        time    : backend.monotonic() when the frame was complete
+        data    : The whole buffer, uint8
+        y       : Luma, shape (height, width)
+        u, v    : Chroma, shape (height // 2, width // 2)
+    """
+
+    __slots__ = ("index", "time", "data", "y", "u", "v")
+
+    def __init__(self, np, resolution):
+        width, height = resolution
+        fwidth, fheight = padded(width, height)
+        self.index = 0
+        self.time = 0.0
+        self.data = np.empty(fwidth * fheight * 3 // 2, dtype=np.uint8)
+        luma = fwidth * fheight
+        chroma = luma // 4
+        self.y = self.data[:luma].reshape((fheight, fwidth))[:height, :width]
+        self.u = self.data[luma : luma + chroma].reshape((fheight // 2, fwidth // 2))[
+            : height // 2, : width // 2
+        ]
+        self.v = self.data[luma + chroma :].reshape((fheight // 2, fwidth // 2))[
+            : height // 2, : width // 2
+        ]
+
+
+# ********************************************************************************
+
+
+class FrameStream(io.IOBase):
+    """ Raw YUV420 stream of the camera, resized to resolution, for subscribers.
+
+    Args:
+        camera          : PiCamera or backend.SimulatedCamera
+        resolution      : (width, height) of the stream
+        splitter_port   : Splitter port, not used by the recording. Default = 2
+        buffers         : Number of frame buffers, at least 3 (one filling, one
+                          waiting and one in the subscribers)
+    """
+
+    def __init__(self, camera, resolution=(320, 240), splitter_port=2, buffers=3):
+        import numpy as np
+
+        super().__init__()
+        self.camera = camera
+        self.resolution = tuple(resolution)
+        self.splitter_port = splitter_port
+        self._free = [Frame(np, self.resolution) for i in range(max(buffers, 3))]
+        self.frame_size = len(self._free[0].data)
+        self._subscribers = []
+        self._cond = threading.Condition()
+        self._ready = None
+        self._stopped = False
+        self._thread = None
+        self._filling = self._free.pop()
+        self._view = memoryview(self._filling.data)
+        self._offset = 0
+        # Statistics
+        self.frames = 0
+        self.dropped = 0
+
+    def subscribe(self, callback):
+        """ Calls callback(frame) with every Frame, in the dispatch thread """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def start(self):
+        logger.info(
+            "Analysis stream {}x{} on splitter port {}".format(
+                *self.resolution, self.splitter_port
+            )
+        )
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="stream", daemon=True)
+        self._thread.start()
+        self.camera.start_recording(
+            self,
+            format="yuv",
+            resize=self.resolution,
+            splitter_port=self.splitter_port,
+        )
+
+    def stop(self):
+        self.camera.stop_recording(splitter_port=self.splitter_port)
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+        logger.info(
+            "Analysis stream: {} frames, {} dropped".format(self.frames, self.dropped)
+        )
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        """ Called by the encoder. A frame may arrive in more than one write """
+        b = memoryview(b).cast("B")
+        size = len(b)
+        while len(b):
+            n = min(len(b), self.frame_size - self._offset)
+            self._view[self._offset : self._offset + n] = b[:n]
+            self._offset += n
+            b = b[n:]
+            if self._offset == self.frame_size:
+                self._publish()
+        return size
+
+    def _publish(self):
+        frame = self._filling
+        frame.index = self.frames
+        frame.time = backend.monotonic()
+        self.frames += 1
+        with self._cond:
+            if self._ready is not None:
+                # The subscribers are still busy: replace the waiting frame
+                self._free.append(self._ready)
+                self.dropped += 1
+                droppedTotal.inc()
+            self._ready = frame
+            self._filling = self._free.pop()
+            self._cond.notify()
+        self._view = memoryview(self._filling.data)
+        self._offset = 0
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._ready is None and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                frame, self._ready = self._ready, None
+            start = time.perf_counter()
+            for callback in list(self._subscribers):
+                try:
+                    callback(frame)
+                except Exception:
+                    logger.exception("Analysis stream subscriber failed")
+            dispatchSeconds.observe(time.perf_counter() - start)
+            with self._cond:
+                self._free.append(frame)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Reruns the motion detection of detect_motion on recorded motion vectors
+    with a grid of parameter sets, to tune mtnMagnitude, mtnMinimumVectors,
+    mtnMinimumBlobSize and mtnMinimumStillSec offline.
+
+    The recordings (.mvec, see motionlog.py, or motion.npy) are memory mapped
+    in the worker processes, so only file names and parameters are sent to the
+    process pool. Every task scores one recording for a chunk of the parameter
+    sets, so each frame is read once per task. The regions and the noise model
+    are taken from config.py, as in camera.py. With a blob size > 0 the blob
+    size decides, not the number of vectors, so those parameter sets have no
+    vectors value ("-").
+
+    Usage: python3 tune.py FILE [FILE ...] [-m 40,60,80] [-v 5:30:5] [-b 0,4,8]
+                           [-s 0,1,2] [-f FRAMERATE] [-j WORKERS]
+
+    A list of values is comma separated, or a range as start:stop:step with
+    stop included.
+"""
+import argparse
+import concurrent.futures
+import math
+import os
+import time
+import numpy as np
+import config
+import motion
+
+
+# --------------------------------------------------------------------------------
+def values(text, kind=float):
+    """ Returns the values of "a,b,c" or "start:stop:step" (stop included) """
+    if ":" in text:
+        start, stop, step = (kind(v) for v in text.split(":"))
+        count = int(math.floor((stop - start) / step + 1e-9)) + 1
+        return [kind(start + i * step) for i in range(count)]
+    return [kind(v) for v in text.split(",")]
+
+
+# --------------------------------------------------------------------------------
+def load(path, framerate):
+    """ Returns (vectors, times) of a recording, vectors memory mapped.
+
+    Args:
+        path        : .mvec or .npy file
+        framerate   : Frames per second of a .npy file
+    """
+    if path.endswith(".npy"):
+        vectors = np.load(path, mmap_mode="r")
+        times = np.arange(len(vectors)) / framerate
+    else:
+        import motionlog
+
+        reader = motionlog.VectorReader(path)
+        vectors = reader.vectors
+        times = np.array(reader.times)
+    return vectors, times.tolist()
+
+
+# --------------------------------------------------------------------------------
+def scorer(shape, params, settings):
+    """ Returns a MotionScorer for a parameter set, configured as detect_motion
+
+    Args:
+        shape       : Shape (rows, cols) of the motion vector grid
+        params      : (magnitude, vectors, blob_size, still_sec), vectors is
+                      None with a blob size
+        settings    : Dictionary with regions, exclusions and noise
+    """
+    magnitude, vectors, blob_size, still_sec = params
+    mask = None
+    if settings["regions"] or settings["exclusions"]:
+        mask = motion.region_mask(shape, settings["regions"], settings["exclusions"])
+    noise = None
+    if settings["noise"] is not None:
+        noise = motion.NoiseModel(*settings["noise"])
+    blobs = None
+    if blob_size > 0:
+        # No time budget offline, so every frame is labelled completely
+        blobs = motion.BlobFinder(blob_size)
+        vectors = 0
+    return motion.MotionScorer(
+        magnitude, vectors, still_sec, mask=mask, noise=noise, blobs=blobs
+    )
+
+
+# --------------------------------------------------------------------------------
+def analyse(path, framerate, grid, settings):
+    """ Runs in a worker process. Returns (path, frames, seconds, events, cpu)
+    with the number of events per parameter set in grid.
+    """
+    vectors, times = load(path, framerate)
+    scorers = [scorer(vectors.shape[1:], params, settings) for params in grid]
+    events = [0] * len(grid)
+    cpu = time.process_time()
+    for i, now in enumerate(times):
+        a = vectors[i]
+        for j, s in enumerate(scorers):
+            if s.detect(a, now):
+                events[j] += 1
+    cpu = time.process_time() - cpu
+    seconds = times[-1] - times[0] + 1 / framerate if times else 0
+    return path, len(times), seconds, events, cpu
+
+
+# --------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rerun the motion detection on recorded motion vectors"
+    )
+    parser.add_argument("files", nargs="+", help=".mvec or motion.npy recordings")
+    parser.add_argument(
+        "-m", "--magnitude", default=str(config.mtnMagnitude), help="mtnMagnitude"
+    )
+    parser.add_argument(
+        "-v",
+        "--vectors",
+        default=str(config.mtnMinimumVectors),
+        help="mtnMinimumVectors",
+    )
+    parser.add_argument(
+        "-b",
+        "--blobs",
+        default=str(config.mtnMinimumBlobSize),
+        help="mtnMinimumBlobSize, 0 = count the vectors",
+    )
+    parser.add_argument(
+        "-s",
+        "--still",
+        default=str(config.mtnMinimumStillSec),
+        help="mtnMinimumStillSec",
+    )
+    parser.add_argument(
+        "-f",
+        "--framerate",
+        type=float,
+        default=config.camFrameRate,
+        help="Frames per second of .npy recordings",
+    )
+    parser.add_argument(
+        "-j", "--workers", type=int, default=os.cpu_count(), help="Worker processes"
+    )
+    args = parser.parse_args()
+
+    # The number of vectors only decides without the blob rule
+    rules = []
+    for blob_size in values(args.blobs, int):
+        if blob_size > 0:
+            rules.append((None, blob_size))
+        else:
+            rules += [(vectors, 0) for vectors in values(args.vectors, int)]
+    grid = [
+        (magnitude, vectors, blob_size, still)
+        for magnitude in values(args.magnitude, int)
+        for vectors, blob_size in rules
+        for still in values(args.still)
+    ]
+    settings = {
+        "regions": config.mtnRegions,
+        "exclusions": config.mtnExclusions,
+        "noise": (config.mtnNoiseAlpha, config.mtnNoiseSigma)
+        if config.mtnNoiseModel
+        else None,
+    }
+    # Enough tasks to keep all workers busy, also with a single recording
+    chunks = max(1, min(len(grid), math.ceil(2 * args.workers / len(args.files))))
+    size = math.ceil(len(grid) / chunks)
+    tasks = [
+        (path, start) for path in args.files for start in range(0, len(grid), size)
+    ]
+
+    events = [0] * len(grid)
+    recordings = {}
+    cpu = 0.0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+        futures = {
+            pool.submit(
+                analyse, path, args.framerate, grid[first : first + size], settings
+            ): first
+            for path, first in tasks
+        }
+        for future in concurrent.futures.as_completed(futures):
+            first = futures[future]
+            path, frames, seconds, counts, used = future.result()
+            recordings[path] = (frames, seconds)
+            for j, n in enumerate(counts):
+                events[first + j] += n
+            cpu += used
+    wall = time.perf_counter() - start
+
+    frames = sum(f for f, s in recordings.values())
+    hours = sum(s for f, s in recordings.values()) / 3600
+    print("magnitude vectors blobs still   events events/h")
+    for (magnitude, vectors, blob_size, still), n in zip(grid, events):
+        print(
+            "{:9d} {:>7} {:5d} {:5g} {:8d} {:8.1f}".format(
+                magnitude,
+                "-" if vectors is None else vectors,
+                blob_size,
+                still,
+                n,
+                n / hours if hours else 0,
+            )
+        )
+    print(
+        "{} recordings, {} frames, {:.2f} h, {} parameter sets".format(
+            len(recordings), frames, hours, len(grid)
+        )
+    )
+    print(
+        "{:.1f} s wall, {:.1f} s CPU, {} workers: {:.0f} frames/s, {:.0f} scored frames/s".format(
+            wall,
+            cpu,
+            args.workers,
+            frames / wall if wall else 0,
+            frames * len(grid) / wall if wall else 0,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Background writer for captured images.
+
+    Captures are taken into memory and handed over through a bounded queue to
+    writer threads, so the capture loop never waits for the SD card or USB stick.
+"""
+import io
+import logging
+import queue
+import threading
+import time
+import metrics
+
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
+logger = logging.getLogger(__name__)
+
+writeSeconds = metrics.histogram(
+    "camera_write_seconds", "Time to write a capture to disk"
+)
+writtenBytes = metrics.counter(
+    "camera_written_bytes_total", "Bytes of captures written"
+)
+droppedTotal = metrics.counter(
+    "camera_writer_dropped_total", "Captures dropped because the writer queue was full"
+)
+
+
+# ********************************************************************************
+
+
+class CaptureWriter:
+    """ Writes captures to disk in background threads.
+
+    Args:
+        queue_size  : Maximum number of captures waiting to be written
+        threads     : Number of writer threads
+        overflow    : What to do when the queue is full: BLOCK the capture loop,
+                      DROP_OLDEST waiting capture or DROP_NEWEST capture
+        on_written  : Function(path, size) called after a capture is written,
+                      in the writer thread. Default = None
+        on_lost     : Function(path) called when a capture is dropped or could
+                      not be written. Default = None
+    """
+
+    def __init__(
+        self, queue_size=16, threads=1, overflow=BLOCK, on_written=None, on_lost=None
+    ):
+        if overflow not in (BLOCK, DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("Invalid overflow: {}".format(overflow))
+        self.overflow = overflow
+        self.on_written = on_written
+        self.on_lost = on_lost
+        self.queue = queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        # Statistics
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.bytes = 0
+        self.max_depth = 0
+        self.write_time = 0.0
+        self.write_max = 0.0
+        metrics.gauge(
+            "camera_writer_queue_depth",
+            "Captures waiting to be written",
+            self.queue.qsize,
+        )
+        self.threads = [
+            threading.Thread(target=self._run, name="writer-{}".format(i), daemon=True)
+            for i in range(threads)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    @property
+    def depth(self):
+        """ Number of captures waiting to be written """
+        return self.queue.qsize()
+
+    def submit(self, path, data):
+        """ Queues a capture to be written. Returns False if it was dropped.
+
+        Args:
+            path    : Filename of the capture
+            data    : bytes or io.BytesIO with the capture
+        """
+        item = (path, data)
+        with self.lock:
+            self.submitted += 1
+            if self.overflow != BLOCK:
+                return self._put_nowait(item)
+        # Block outside the lock, the writers do not need it to make room
+        self.queue.put(item)
+        with self.lock:
+            return self._queued()
+
+    def _put_nowait(self, item):
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return self._queued()
+            except queue.Full:
+                if self.overflow == DROP_NEWEST:
+                    self._drop(item[0])
+                    return False
+            try:
+                oldest = self.queue.get_nowait()
+            except queue.Empty:
+                continue
+            self.queue.task_done()
+            self._drop(oldest[0])
+
+    def _queued(self):
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def _drop(self, path):
+        self.dropped += 1
+        droppedTotal.inc()
+        logger.warning("Writer queue full, dropped {}".format(path))
+        self._callback(self.on_lost, path)
+
+    def flush(self):
+        """ Waits until all queued captures are written """
+        self.queue.join()
+
+    def close(self):
+        """ Writes all queued captures and stops the writer threads """
+        logger.info("close writer")
+        self.flush()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        logger.info(
+            "Writer: {} written, {} dropped, {} errors, max. queue {}, avg. {:.1f} ms".format(
+                self.written,
+                self.dropped,
+                self.errors,
+                self.max_depth,
+                self.write_time / self.written * 1000 if self.written else 0,
+            )
+        )
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, path, data):
+        if isinstance(data, io.BytesIO):
+            data = data.getbuffer()
+        start = time.perf_counter()
+        try:
+            with io.open(path, "wb") as f:
+                f.write(data)
+        except Exception:
+            logger.exception("Writing {} failed".format(path))
+            with self.lock:
+                self.errors += 1
+            self._callback(self.on_lost, path)
+            return
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.written += 1
+            self.bytes += len(data)
+            self.write_time += elapsed
+            self.write_max = max(self.write_max, elapsed)
+        writeSeconds.observe(elapsed)
+        writtenBytes.inc(len(data))
+        logger.debug("written {} in {:.1f} ms".format(path, elapsed * 1000))
+        self._callback(self.on_written, path, len(data))
+
+    def _callback(self, callback, *args):
+        """ Calls a callback, an exception must not stop the writer thread """
+        if callback is None:
+            return
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception("Callback for {} failed".format(args[0]))